@@ -12,10 +12,12 @@ import json
 # Thrift files for HBase should be in the same directory with this script
 import hbase
 
-from thrift.transport.TSocket import TSocket
-from thrift.transport.TTransport import TBufferedTransport
-from thrift.protocol import TBinaryProtocol
+# Column layout of table tweets, schema.py should be in the same directory
+# with this script as well
+import schema
+
 from hbase import *
+from hbase.pool import ConnectionPool
 from hbase.ttypes import *
 
 # Target thrift server.
@@ -23,6 +25,9 @@ from hbase.ttypes import *
 THRIFT_SERVER = 'master.hadoop.lab'
 THRIFT_PORT = 9090
 
+# Connections shared by all worker threads
+POOL = ConnectionPool(THRIFT_SERVER, THRIFT_PORT, maxsize=8)
+
 print_lock = thread.allocate_lock()
 
 def usage():
@@ -30,79 +35,14 @@ def usage():
   print('  A worker thread will be created for each of input file.')
   print('  DO NOT pass too many files.')
 
-def add_field(mlist, t, name, cf=''):
-  if not name in t:
-    mlist.append(Mutation(column=cf+name+':', value=json.dumps(None)))
-  else:
-    mlist.append(Mutation(column=cf+name+':', value=json.dumps(t[name]).encode('utf8')))
-
 def create_mutations(t):
-  mlist = []
-  
-  # basic fields
-  add_field(mlist, t, 'idstr')
-  add_field(mlist, t, 'text')
-  add_field(mlist, t, 'created_at')
-  add_field(mlist, t, 'geo')
-  add_field(mlist, t, 'source')
-  add_field(mlist, t, 'truncated')
-  add_field(mlist, t, 'comments_count')
-  add_field(mlist, t, 'reposts_count')
-  
-  # user fields
-  user = t['user']
-  add_field(mlist, user, 'idstr', 'user:')
-  add_field(mlist, user, 'name', 'user:')
-  add_field(mlist, user, 'gender', 'user:')
-  add_field(mlist, user, 'location', 'user:')
-  add_field(mlist, user, 'province', 'user:')
-  add_field(mlist, user, 'city', 'user:')
-  add_field(mlist, user, 'created_at', 'user:')
-  add_field(mlist, user, 'description', 'user:')
-  add_field(mlist, user, 'url', 'user:')
-  add_field(mlist, user, 'bi_followers_count', 'user:')
-  add_field(mlist, user, 'friends_count', 'user:')
-  add_field(mlist, user, 'followers_count', 'user:')
-  add_field(mlist, user, 'statuses_count', 'user:')
-  
-  # retweet fields
-  if 'retweeted_status' in t:
-    rt = t['retweeted_status']
-    # basic fields of retweeted status
-    add_field(mlist, rt, 'idstr', 'rt:')
-    add_field(mlist, rt, 'text', 'rt:')
-    add_field(mlist, rt, 'created_at', 'rt:')
-    add_field(mlist, rt, 'geo', 'rt:')
-    add_field(mlist, rt, 'source', 'rt:')
-    add_field(mlist, rt, 'truncated', 'rt:')
-    add_field(mlist, rt, 'comments_count', 'rt:')
-    add_field(mlist, rt, 'reposts_count', 'rt:')
-    
-    # user fields of retweeted status
-    if 'user' in rt:
-      rt_user = rt['user']
-      add_field(mlist, rt_user, 'idstr', 'rt:user:')
-      add_field(mlist, rt_user, 'name', 'rt:user:')
-      add_field(mlist, rt_user, 'gender', 'rt:user:')
-      add_field(mlist, rt_user, 'location', 'rt:user:')
-      add_field(mlist, rt_user, 'province', 'rt:user:')
-      add_field(mlist, rt_user, 'city', 'rt:user:')
-      add_field(mlist, rt_user, 'created_at', 'rt:user:')
-      add_field(mlist, rt_user, 'description', 'rt:user:')
-      add_field(mlist, rt_user, 'url', 'rt:user:')
-      add_field(mlist, rt_user, 'bi_followers_count', 'rt:user:')
-      add_field(mlist, rt_user, 'friends_count', 'rt:user:')
-      add_field(mlist, rt_user, 'followers_count', 'rt:user:')
-      add_field(mlist, rt_user, 'statuses_count', 'rt:user:')
-  return mlist
+  ''' Creates a mutation list based on the tweet struct. '''
+  return [Mutation(column=col, value=v) for (col, v) in schema.tweet_cells(t)]
 
 def do_import(n, filename):
   try:
-    transport = TBufferedTransport(TSocket(THRIFT_SERVER, THRIFT_PORT))
-    transport.open()
-    protocol = TBinaryProtocol.TBinaryProtocol(transport)
-    client = Hbase.Client(protocol)
-    
+    client = POOL.client()
+
     fp = open(filename)
     tweets = json.load(fp)
     fp.close()
@@ -137,5 +77,6 @@ for n in range(1, len(sys.argv)):
 
 for th in threads:
   th.join()
+POOL.close()
 
 print('Mission complete.')
@@ -8,9 +8,18 @@ import threading
 import time
 import socket
 import cgi
+import json
+import bisect
+import atexit
+import shutil
+import urllib
+import urlparse
+import SocketServer
+import BaseHTTPServer
 
 from threading import Thread
 from threading import Event
+from collections import deque
 
 def getcmdline():
   ''' Get command line of current python program '''
@@ -20,33 +29,6 @@ def getcmdline():
     cmdline += ' '
   return cmdline
 
-def closesocket(sock):
-  ''' Shutdown and close the socket. '''
-  try:
-    sock.shutdown(socket.SHUT_RDWR)
-    sock.close()
-  except Exception, e:
-    pass
-
-def get_http_target(requestline):
-  requestline = requestline.replace('\t', ' ')
-  parts = requestline.split(' ')
-  method = ''
-  target = ''
-  cursor = 0
-  for e in parts:
-    if cursor == 0:
-      if e != '':
-        method = e
-        cursor += 1
-    elif cursor == 1:
-      if e != '':
-        target = e
-        cursor += 1
-    else:
-      break
-  return [method, target]
-
 # See: http://stackoverflow.com/questions/1094841
 # Origin:  http://blogmag.net/blog/read/38/Print_human_readable_file_size
 def filesizefmt(size):
@@ -55,7 +37,448 @@ def filesizefmt(size):
           return "%3.1f %s" % (size, x)
       size /= 1024.0
 
+class Counters(object):
+  ''' Counters added to by many threads. Every thread adds to a slot of its
+  own, a list of ints, so that adding takes no lock and allocates nothing
+  once the slot exists. values() folds the slots of all threads. Slots of
+  finished threads are kept, their counts still belong to the totals.
+  @names  counter names, the index of a name is its index within a slot
+  '''
+  def __init__(self, names):
+    self._names = tuple(names)
+    self._index = dict([(n, i) for (i, n) in enumerate(self._names)])
+    self._local = threading.local()
+    self._slots = []
+    self._slots_lock = thread.allocate_lock()
+
+  def index(self, name):
+    return self._index[name]
+
+  def slot(self):
+    ''' Returns the slot of the calling thread '''
+    try:
+      return self._local.slot
+    except AttributeError:
+      slot = [0] * len(self._names)
+      with self._slots_lock:
+        self._slots.append(slot)
+      self._local.slot = slot
+      return slot
+
+  def add(self, name, n=1):
+    self.slot()[self._index[name]] += n
+
+  def values(self):
+    ''' Returns the totals of all threads as a list, in the order of names '''
+    res = [0] * len(self._names)
+    with self._slots_lock:
+      slots = list(self._slots)
+    for slot in slots:
+      for i in range(len(res)):
+        res[i] += slot[i]
+    return res
+
+
+class LogRing(object):
+  ''' The last lines of a log, held in a list of fixed size that is
+  written round robin. Lines are stored HTML escaped, so rendering them is
+  a join of the lines asked for.
+  @capacity  number of lines kept
+  '''
+  def __init__(self, capacity=80):
+    self._lines = [None] * max(1, capacity)
+    self._next = 0      # index the next line goes to
+    self._count = 0     # number of lines held
+    self._lock = thread.allocate_lock()
+
+  def __len__(self):
+    return self._count
+
+  def capacity(self):
+    return len(self._lines)
+
+  def append(self, line):
+    line = cgi.escape(line, True)
+    with self._lock:
+      self._lines[self._next] = line
+      self._next += 1
+      if self._next == len(self._lines):
+        self._next = 0
+      if self._count < len(self._lines):
+        self._count += 1
+
+  def lines(self, n=None):
+    ''' Returns the last n lines, all lines if n is None, oldest first '''
+    with self._lock:
+      if n is None or n > self._count:
+        n = self._count
+      if n <= 0:
+        return []
+      start = self._next - n
+      if start >= 0:
+        return self._lines[start:self._next]
+      return self._lines[start:] + self._lines[:self._next]
+
+
+def _replace(src, dst):
+  ''' Renames src to dst, replacing dst. os.rename() fails on Windows if
+  dst exists.
+  '''
+  if os.path.exists(dst):
+    os.remove(dst)
+  os.rename(src, dst)
+
+class LogWriter(object):
+  ''' Writes log lines to a file from a thread of its own, so that logging
+  does not wait for the disk. Lines are queued and written in batches,
+  then flushed, at least every flush_interval seconds. Once max_queued
+  lines are waiting, more lines are dropped and counted in dropped, a
+  warning with the count is written when there is room again.
+  @path            log file, truncated when opened
+  @max_bytes       rotate the file once it grows past this size, 0 never
+  @backups         rotated files kept, as path.1 (newest) to path.N
+  @max_queued      max lines waiting to be written
+  @flush_interval  seconds between writes, at most
+  '''
+  def __init__(self, path, max_bytes=0, backups=3, max_queued=10000, flush_interval=1.0):
+    self.path = path
+    self.dropped = 0
+    self._max_bytes = max_bytes
+    self._backups = backups
+    self._max_queued = max_queued
+    self._batch = max(1, max_queued // 4)  # lines that wake the writer early
+    self._interval = flush_interval
+    self._f = open(path, 'w')
+    self._size = 0
+    self._queue = []
+    self._queued = 0      # lines queued so far
+    self._written = 0     # lines of those written and flushed
+    self._cond = threading.Condition()
+    self._wake = Event()
+    self._closed = False
+    self._th = Thread(target=self._run, name='logwriter')
+    self._th.setDaemon(True)
+    self._th.start()
+    # write what is left before the interpreter tears the thread down
+    atexit.register(self.close)
+
+  def write(self, line):
+    ''' Queues line, returns False if it was dropped '''
+    with self._cond:
+      if self._closed or len(self._queue) >= self._max_queued:
+        self.dropped += 1
+        return False
+      self._queue.append(line)
+      self._queued += 1
+      if len(self._queue) == self._batch:
+        self._wake.set()
+    return True
+
+  def flush(self):
+    ''' Waits until the lines queued so far are written and flushed '''
+    with self._cond:
+      queued = self._queued
+      self._wake.set()
+      while self._written < queued and self._th.is_alive():
+        self._cond.wait(0.1)
+
+  def close(self):
+    with self._cond:
+      self._closed = True
+    self._wake.set()
+    self._th.join()
+
+  def _run(self):
+    reported = 0
+    while True:
+      self._wake.wait(self._interval)
+      self._wake.clear()
+      with self._cond:
+        (lines, self._queue) = (self._queue, [])
+        queued = self._queued
+        dropped = self.dropped
+        closed = self._closed
+      if dropped != reported:
+        lines.append('%s  [WARNING] %d log lines dropped, log writer fell behind\n' %
+                     (time.strftime('%Y-%m-%d %H:%M:%S'), dropped - reported))
+        reported = dropped
+      if lines:
+        self._write(''.join(lines))
+      with self._cond:
+        self._written = queued
+        self._cond.notify_all()
+      if closed:
+        break
+    self._f.close()
+
+  def _write(self, data):
+    try:
+      if self._f.closed:
+        # reopening failed after a rotation, try again
+        self._reopen()
+      self._f.write(data)
+      self._f.flush()
+      self._size += len(data)
+      if self._max_bytes > 0 and self._size >= self._max_bytes:
+        self._rotate()
+    except Exception, e:
+      # a full or missing disk must not stop the import
+      pass
+
+  def _rotate(self):
+    self._f.close()
+    try:
+      for n in range(self._backups - 1, 0, -1):
+        src = '%s.%d' % (self.path, n)
+        if os.path.exists(src):
+          _replace(src, '%s.%d' % (self.path, n + 1))
+      if self._backups > 0:
+        _replace(self.path, self.path + '.1')
+    finally:
+      # after a failed rotation the current file grows on
+      self._reopen()
+
+  def _reopen(self):
+    self._f = open(self.path, 'a')
+    self._size = os.path.getsize(self.path)
+
+
+class Histogram(object):
+  ''' Distribution of observed values, e.g. call latencies, counted in
+  buckets with upper bounds bounds, like a Prometheus histogram. Counts go
+  to the Counters slot of the observing thread.
+  @bounds  ascending bucket upper bounds, a last bucket takes the rest
+  '''
+  def __init__(self, bounds):
+    self.bounds = tuple(bounds)
+    self._sum = len(self.bounds) + 1
+    self._counters = Counters(['le%s' % b for b in self.bounds] + ['inf', 'sum'])
+
+  def observe(self, v):
+    slot = self._counters.slot()
+    slot[bisect.bisect_left(self.bounds, v)] += 1
+    slot[self._sum] += v
+
+  def values(self):
+    ''' Returns (bucket counts, sum of values) '''
+    res = self._counters.values()
+    return (res[:self._sum], res[self._sum])
+
+  def percentile(self, q, counts=None):
+    ''' Estimates the q-quantile, 0 < q < 1, interpolating within the
+    bucket it falls in. Returns None if nothing has been observed.
+    '''
+    if counts is None:
+      counts = self.values()[0]
+    total = sum(counts)
+    if total == 0:
+      return None
+    rank = q * total
+    seen = 0
+    for (i, n) in enumerate(counts):
+      if n > 0 and seen + n >= rank:
+        if i == len(self.bounds):
+          return self.bounds[-1]
+        lower = 0.0
+        if i > 0:
+          lower = self.bounds[i - 1]
+        return lower + (self.bounds[i] - lower) * (rank - seen) / n
+      seen += n
+    return self.bounds[-1]
+
+
+# Counters of TaskTracker, the index of each within a Counters slot
+FILES = 0
+RECORDS = 1
+BYTES = 2
+COUNTER_NAMES = ('files', 'records', 'bytes')
+
+# Levels of log messages, counted by TaskTracker.log()
+LOG_LEVELS = ('INFO', 'WARNING', 'ERROR', 'FATAL')
+_LEVEL_INDEX = dict([(l, i) for (i, l) in enumerate(LOG_LEVELS)])
+
+# Upper bounds in seconds of the buckets of latency histograms
+LATENCY_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                  1.0, 2.5, 5.0, 10.0)
+
+# Windows of the rates, in seconds, and the interval counters are sampled
+# at for them
+RATE_WINDOWS = (('1m', 60), ('5m', 300), ('15m', 900))
+SAMPLE_INTERVAL = 5
+
+# Log lines shown by the console page unless more are asked for with
+# ?lines=N, up to the lines kept
+SUMMARY_LINES = 80
+
+# Percentiles of histograms reported
+PERCENTILES = (0.5, 0.9, 0.99)
+
+# Content type of the Prometheus text format
+METRICS_CTYPE = 'text/plain; version=0.0.4'
+
+def _label(v):
+  ''' Escapes a Prometheus label value '''
+  return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _metric(out, name, mtype, help, samples):
+  ''' Appends a metric in Prometheus text format to list out.
+  @samples  list of (labels, value), labels being a string like
+            'window="1m"' or ''
+  '''
+  out.append('# HELP gem_%s %s\n# TYPE gem_%s %s\n' % (name, help, name, mtype))
+  for (labels, value) in samples:
+    if isinstance(value, (int, long)):
+      value = str(value)
+    else:
+      value = repr(float(value))
+    if labels:
+      out.append('gem_%s{%s} %s\n' % (name, labels, value))
+    else:
+      out.append('gem_%s %s\n' % (name, value))
+
+def file_type(fname):
+  ''' Returns the content type files served by the control interface are
+  sent with
+  '''
+  if fname.endswith('.htm') or fname.endswith('.html'):
+    return 'text/html'
+  elif fname.endswith('.txt') or fname.endswith('.log') or \
+       fname.endswith('.py') or fname.endswith('.sh') :
+    return 'text/plain'
+  return 'application/octet-stream'
+
+def local_path(path):
+  ''' Maps the path of a request to a file below the working directory.
+  Returns None for paths leading out of it.
+  '''
+  path = urllib.unquote(path)
+  # backslashes and drives are separators on Windows, NULs are invalid
+  if '\\' in path or ':' in path or '\0' in path:
+    return None
+  root = os.path.realpath(os.getcwd())
+  fname = os.path.realpath(os.path.join(root, *path.split('/')))
+  if not fname.startswith(root + os.sep):
+    return None
+  return fname
+
+
+class ControlServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  ''' The control interface of a TaskTracker. Every connection is served
+  by a thread of its own, so a slow client or a long download only holds
+  up itself, and none of them runs in the task thread.
+  @tracker  TaskTracker the requests go to
+  '''
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 16
+
+  def __init__(self, addr, tracker):
+    BaseHTTPServer.HTTPServer.__init__(self, addr, ControlHandler)
+    self.tracker = tracker
+    self._conns = set()     # connections being served
+    self._conns_lock = thread.allocate_lock()
+
+  def process_request(self, request, client_address):
+    with self._conns_lock:
+      self._conns.add(request)
+    SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+  def shutdown_request(self, request):
+    with self._conns_lock:
+      self._conns.discard(request)
+    BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+  def close_connections(self):
+    ''' Cuts the connections still open, e.g. kept alive by clients, so
+    that their threads end
+    '''
+    with self._conns_lock:
+      conns = list(self._conns)
+    for conn in conns:
+      try:
+        conn.shutdown(socket.SHUT_RDWR)
+      except socket.error, e:
+        pass
+
+  def handle_error(self, request, client_address):
+    e = sys.exc_info()[1]
+    # ignore client side network errors
+    if not isinstance(e, socket.error):
+      self.tracker.log('[WARNING] gem control interface, client %s: %s' % (client_address[0], e))
+
+
+class ControlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  ''' Requests to the control interface, see ControlServer. Connections
+  are kept alive between requests, and closed once a client stays silent
+  for timeout seconds.
+  '''
+  protocol_version = 'HTTP/1.1'
+  server_version = 'gem'
+  timeout = 15
+
+  def do_GET(self):
+    tracker = self.server.tracker
+    url = urlparse.urlsplit(self.path)
+    if url.path == '/':
+      query = urlparse.parse_qs(url.query)
+      lines = SUMMARY_LINES
+      if 'lines' in query:
+        try:
+          lines = int(query['lines'][-1])
+        except ValueError, e:
+          self.send_error(400, 'Bad lines')
+          return
+      self._reply('text/html', tracker.summary_page(lines=lines))
+    elif url.path == '/metrics':
+      self._reply(METRICS_CTYPE, tracker.metrics_text())
+    elif url.path == '/status.json':
+      self._reply('application/json', tracker.status_json())
+    else:
+      self._send_file(url.path)
+
+  def do_POST(self):
+    # the console page posts a date, which is of no use
+    length = int(self.headers.getheader('Content-Length') or 0)
+    if length > 0:
+      self.rfile.read(length)
+    if urlparse.urlsplit(self.path).path == '/ctl/stop':
+      self.server.tracker.request_stop()
+      self._reply('text/plain', '')
+    else:
+      self.send_error(400)
+
+  def _reply(self, ctype, body):
+    self.send_response(200)
+    self.send_header('Content-Type', ctype)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _send_file(self, path):
+    fname = local_path(path)
+    f = None
+    try:
+      if fname is not None and os.path.isfile(fname):
+        f = open(fname, 'rb')
+    except IOError, e:
+      pass
+    if f is None:
+      self.send_error(404)
+      return
+    with f:
+      self.send_response(200)
+      self.send_header('Content-Type', file_type(fname))
+      self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+      self.end_headers()
+      shutil.copyfileobj(f, self.wfile)
+
+  def log_message(self, format, *args):
+    # requests are not logged
+    pass
+
+
 class TaskInformation(object):
+  ''' Task status as of the last TaskTracker.snapshot() '''
   def __init__(self):
     self.pid = os.getpid()
     self.cmdline = getcmdline()
@@ -71,16 +494,35 @@ class TaskInformation(object):
 
 
 class TaskTracker(object):
-  def __init__(self, addr = '0.0.0.0', port = 10086):
+  def __init__(self, addr = '0.0.0.0', port = 10086, loglines = 80, logmax = 0):
     self._taskth = None  # task thread
-    self._tasklog = []
-    self._tasklog_lock = thread.allocate_lock()
-    self._tasklogf = open('log/gem.%d.log' % os.getpid(), 'w')
+    self._tasklog = LogRing(loglines)
+    self._tasklogf = LogWriter('log/gem.%d.log' % os.getpid(), max_bytes=logmax)
     self.taskinf = TaskInformation()
 
+    # Status updates only add to counters or set a field. They are folded
+    # into taskinf by snapshot(), when somebody looks.
+    self._counters = Counters(COUNTER_NAMES)
+    self._current_file = ''
+    self._prog_max = 100
+    self._prog_val = 0
+    self._snap_lock = thread.allocate_lock()
+    # status folded last, to tell if it changed
+    self._snap_last = (0, 0, 0L, '', 0, 100)
+    # (time, files, records, bytes) every SAMPLE_INTERVAL seconds, back to
+    # the longest of RATE_WINDOWS. The first one is the start, with
+    # nothing processed yet.
+    self._started = time.time()
+    self._samples = deque([(self._started, 0, 0, 0L)])
+
+    # Metrics registered by the task, see histogram() and add_gauge()
+    self._levels = Counters(LOG_LEVELS)
+    self._histograms = []   # (name, help, Histogram)
+    self._gauges = []       # (name, help, label, func)
+
     self._waddr = addr
     self._wport = port
-    self._sock = None    # listening socket
+    self._server = None  # ControlServer
     self._ctlth = None   # controller thread
     self._ctlf = Event()
 
@@ -88,44 +530,6 @@ class TaskTracker(object):
     with open('gem.htm') as h:
       self._html = h.read()
   
-  def _ctl_event_loop(self):
-    self.log('[INFO] Starting gem control interface at: http://%s:%s' % (self._waddr, self._wport))
-    conn = None
-    while self._taskth.is_alive():
-      try:
-        (conn, addr) = self._sock.accept()
-      except socket.timeout, e:
-        continue
-      except Exception, e:
-        # exit event loop on server side network errors
-        self.log('[ERROR] gem control interface down! Network error: %s' % e)
-        break
-
-      try:
-        conn.settimeout(3)
-        requestline = conn.recv(1024).splitlines()[0]
-        conn.settimeout(None)
-        [method, target] = get_http_target(requestline)
-        if method == 'GET':
-          if target == '/':
-            conn.send(self.response_summary())
-          else:
-            conn.send(self.response_file('.' + target))
-        elif method == 'POST':
-          if target == '/ctl/stop':
-            self.log('[INFO] gem control interface got a STOP command.')
-            self._ctlf.set()
-            conn.send('HTTP/1.1 200 OK\r\nServer: gem\r\n\r\n')
-          else:
-            conn.send(self.response_400())
-        else:
-          conn.send(self.response_400())
-      except Exception, e:
-        # ignore client side network errors
-        pass
-      finally:
-        closesocket(conn)
-    
   def run(self, target, args):
     ''' Run the task and tracker '''
     if self._taskth != None or self._ctlth != None:
@@ -133,59 +537,53 @@ class TaskTracker(object):
       return 1
 
     try:
-      self._sock = socket.socket()
-      self._sock.bind((self._waddr, self._wport))
-      self._sock.listen(4)
-      self._sock.settimeout(3)
+      self._server = ControlServer((self._waddr, self._wport), self)
     except Exception, e:
       self.log('[ERROR] Failed to start task tracker, network error: %s' % e)
       return 1
 
     self.taskinf.pid = os.getpid()
     self.taskinf.cmdline = getcmdline()
-    self.taskinf.startup_at = time.strftime('%Y-%m-%d %H:%M:%S')
-    self.taskinf.updated_at = time.strftime('%Y-%m-%d %H:%M:%S')
+    self._started = time.time()
+    with self._snap_lock:
+      self._samples = deque([(self._started, 0, 0, 0L)])
+    self.taskinf.startup_at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self._started))
+    self.taskinf.updated_at = self.taskinf.startup_at
     self.log('[INFO] Starting TaskTracker PID=%d, running command %s' % (self.taskinf.pid, self.taskinf.cmdline))
     self._taskth = Thread(target=target, args=args)
     self._taskth.start()
 
     self._ctlf.clear()
-    self._ctlth = Thread(target=self._ctl_event_loop)
+    self._ctlth = Thread(target=self._server.serve_forever, name='gem-control')
+    self._ctlth.setDaemon(True)
     self._ctlth.start()
-    self._taskth.join()
-    
-    # controller thread exits automatically after task thread is terminated
+    self.log('[INFO] Starting gem control interface at: http://%s:%s' % (self._waddr, self._wport))
+    while self._taskth.is_alive():
+      self._taskth.join(SAMPLE_INTERVAL)
+      # keeps the samples of the rates going while nobody looks
+      self.snapshot()
+
+    # the control interface goes down with the task
+    self._server.shutdown()
+    self._server.server_close()
+    self._server.close_connections()
     self._ctlth.join()
-    self._sock.close()
 
     if self.fstop():
       self.log('[INFO] Mission aborted.')
     else:
       self.log('[INFO] Mission complete.')
+    self._tasklogf.flush()
     return 0
 
-  def compose_200_header(self, clen, ctype):
-    header = 'HTTP/1.1 200 OK\r\n'\
-             'Server: gem\r\n'\
-             'Connection: close\r\n'\
-             'Content-Length: %d\r\n'\
-             'Content-Type: %s\r\n\r\n' % (clen, ctype)
-    return header
-
-  def response_400(self):
-    header = 'HTTP/1.1 400 Bad Request\r\n'\
-             'Server: gem\r\n'\
-             'Connection: close\r\n\r\n'
-    return header
-
-  def sync_output(self):
-    self.taskinf.output = ''
-    with self._tasklog_lock:
-      for l in self._tasklog:
-        self.taskinf.output += l
-    self.taskinf.output = cgi.escape(self.taskinf.output, True)
-
-  def response_summary(self, autorefresh = 5):
+  def sync_output(self, lines = None):
+    ''' Sets taskinf.output to the last lines of the log, HTML escaped '''
+    self.taskinf.output = ''.join(self._tasklog.lines(lines))
+
+  def summary_page(self, autorefresh = 5, lines = SUMMARY_LINES):
+    ''' Renders the console page.
+    @lines  number of log lines shown, all lines kept if None
+    '''
     refresh_meta = ''
     if autorefresh > 0:
       refresh_meta = '<meta http-equiv="refresh" content="%d">' % autorefresh
@@ -194,8 +592,8 @@ class TaskTracker(object):
     if self.fstop():
       task_status = '<label class="attention">Waiting to stop</label>'
 
-    self.sync_output()
-    inf = self.taskinf
+    self.sync_output(lines)
+    inf = self.snapshot()
 
     loganchor = '<a href="/log/gem.%d.log">log/gem.%d.log</a>' % (inf.pid, inf.pid)
 
@@ -203,69 +601,222 @@ class TaskTracker(object):
            inf.updated_at, inf.files_processed, inf.records_processed, \
            filesizefmt(inf.bytes_processed), inf.current_file, inf.prog_val, \
            inf.prog_max, task_status, inf.output, loganchor)
-    header = self.compose_200_header(len(body), 'text/html')
-    return header + body
-
-  def response_file(self, fname, ctype=None):
-    if ctype == None:
-      if fname.endswith('.htm') or fname.endswith('.html'):
-        ctype = 'text/html'
-      elif fname.endswith('.txt') or fname.endswith('.log') or \
-           fname.endswith('.py') or fname.endswith('.sh') :
-        ctype = 'text/plain'
-      else:
-        ctype = 'application/octet-stream'
-    response = ''
-    try:
-      with open(fname) as f:
-        body = f.read()
-      header = self.compose_200_header(len(body), ctype)
-      response = header + body
-    except:
-      response = 'HTTP/1.1 404 Not Found\r\nServer: gem\r\n\r\n'
-    return response
+    return body
 
   def fstop(self):
     ''' Check if the stop flag is set '''
     return self._ctlf.is_set()
 
+  def request_stop(self):
+    ''' Sets the stop flag, the task is expected to poll fstop() '''
+    self.log('[INFO] gem control interface got a STOP command.')
+    self._ctlf.set()
+
   def log(self, msg):
     try:
+      if msg.startswith('['):
+        level = _LEVEL_INDEX.get(msg[1:msg.find(']')])
+        if level is not None:
+          self._levels.slot()[level] += 1
       logline = time.strftime('%Y-%m-%d %H:%M:%S') + '  ' + msg + '\n'
-      with self._tasklog_lock:
-        self._tasklog.append(logline)
-        if len(self._tasklog) > 80:
-          self._tasklog.pop(0)
+      self._tasklog.append(logline)
       self._tasklogf.write(logline)
-      self._tasklogf.flush()
     except:
       pass
 
+  def add_files(self, n=1):
+    self._counters.slot()[FILES] += n
+
+  def add_records(self, n=1):
+    self._counters.slot()[RECORDS] += n
+
+  def add_bytes(self, n):
+    self._counters.slot()[BYTES] += n
+
+  def set_current(self, fname):
+    self._current_file = fname
+
   def update_task_status(self, files = None, records = None, bytes = None, current = None):
     ''' Updates task status '''
+    slot = self._counters.slot()
     if files != None:
-      self.taskinf.files_processed += files
+      slot[FILES] += files
     if records != None:
-      self.taskinf.records_processed += records
+      slot[RECORDS] += records
     if bytes != None:
-      self.taskinf.bytes_processed += bytes
+      slot[BYTES] += bytes
     if current != None:
-      self.taskinf.current_file = current
-    self.taskinf.updated_at = time.strftime('%Y-%m-%d %H:%M:%S')
+      self._current_file = current
 
   def update_progress(self, value, max = None):
-    self.taskinf.prog_val = value
+    self._prog_val = value
     if max != None:
-      self.taskinf.prog_max = max
-    self.taskinf.updated_at = time.strftime('%Y-%m-%d %H:%M:%S')
+      self._prog_max = max
+
+  def snapshot(self):
+    ''' Folds the counters of all threads into taskinf and returns it.
+    updated_at is the time of the first snapshot that saw the status change.
+    '''
+    with self._snap_lock:
+      inf = self.taskinf
+      (files, records, bytes) = self._counters.values()
+      status = (files, records, bytes, self._current_file, self._prog_val, self._prog_max)
+      if status != self._snap_last:
+        self._snap_last = status
+        (inf.files_processed, inf.records_processed, inf.bytes_processed,
+         inf.current_file, inf.prog_val, inf.prog_max) = status
+        inf.updated_at = time.strftime('%Y-%m-%d %H:%M:%S')
+      now = time.time()
+      if not self._samples or now - self._samples[-1][0] >= SAMPLE_INTERVAL:
+        self._samples.append((now, files, records, bytes))
+        # keep the newest sample at least as old as the longest window
+        oldest = now - RATE_WINDOWS[-1][1]
+        while len(self._samples) > 1 and self._samples[1][0] <= oldest:
+          self._samples.popleft()
+      return inf
+
+  def rates(self):
+    ''' Returns [(window name, files/s, records/s, bytes/s)] for
+    RATE_WINDOWS. A window reaching back before the first sample gives the
+    rate since then.
+    '''
+    inf = self.snapshot()
+    now = time.time()
+    cur = (inf.files_processed, inf.records_processed, inf.bytes_processed)
+    with self._snap_lock:
+      samples = list(self._samples)
+    res = []
+    for (name, secs) in RATE_WINDOWS:
+      base = samples[0]
+      for sample in samples:
+        if sample[0] > now - secs:
+          break
+        base = sample
+      elapsed = now - base[0]
+      if elapsed <= 0:
+        res.append((name, 0.0, 0.0, 0.0))
+      else:
+        res.append(tuple([name] + [(c - b) / elapsed for (c, b) in zip(cur, base[1:])]))
+    return res
+
+  def histogram(self, name, help, bounds=LATENCY_BOUNDS):
+    ''' Returns the Histogram exported as gem_<name>, created on first use '''
+    for (n, hlp, h) in self._histograms:
+      if n == name:
+        return h
+    h = Histogram(bounds)
+    self._histograms.append((name, help, h))
+    return h
+
+  def add_gauge(self, name, help, func, label=None):
+    ''' Exports the value of func() as gauge gem_<name>, replacing a gauge
+    of that name. With label set, func returns a list of (label value,
+    value) instead, e.g. queue depths by stage.
+    '''
+    self._gauges = [g for g in self._gauges if g[0] != name]
+    self._gauges.append((name, help, label, func))
+
+  def _gauge_values(self, label, func):
+    ''' Returns [(label value, value)] of a gauge, label value None if it
+    has no label
+    '''
+    try:
+      if label is None:
+        return [(None, func())]
+      return list(func())
+    except Exception, e:
+      # the object behind a gauge may be gone
+      return []
+
+  def metrics_text(self):
+    ''' Renders the status in Prometheus text format '''
+    rates = self.rates()
+    inf = self.taskinf
+    out = []
+    _metric(out, 'start_time_seconds', 'gauge', 'Time the task was started.',
+            [('', self._started)])
+    _metric(out, 'files_processed_total', 'counter', 'Files imported.',
+            [('', inf.files_processed)])
+    _metric(out, 'records_processed_total', 'counter', 'Records written.',
+            [('', inf.records_processed)])
+    _metric(out, 'bytes_processed_total', 'counter', 'Uncompressed bytes read.',
+            [('', inf.bytes_processed)])
+    for (i, unit) in ((1, 'files'), (2, 'records'), (3, 'bytes')):
+      _metric(out, '%s_per_second' % unit, 'gauge', 'Average %s per second over a window.' % unit,
+              [('window="%s"' % r[0], r[i]) for r in rates])
+    _metric(out, 'progress', 'gauge', 'Progress within the current file, 0 to 1.',
+            [('', float(inf.prog_val) / max(1, inf.prog_max))])
+    _metric(out, 'stopping', 'gauge', '1 once a stop was requested.', [('', int(self.fstop()))])
+    _metric(out, 'log_messages_total', 'counter', 'Log messages by level.',
+            [('level="%s"' % l.lower(), n) for (l, n) in zip(LOG_LEVELS, self._levels.values())])
+    for (name, help, h) in self._histograms:
+      (counts, total) = h.values()
+      out.append('# HELP gem_%s %s\n# TYPE gem_%s histogram\n' % (name, help, name))
+      seen = 0
+      for (bound, n) in zip(h.bounds + ('+Inf',), counts):
+        seen += n
+        out.append('gem_%s_bucket{le="%s"} %d\n' % (name, bound, seen))
+      out.append('gem_%s_sum %r\ngem_%s_count %d\n' % (name, float(total), name, seen))
+      _metric(out, name + '_percentile', 'gauge', 'Estimated percentiles of %s.' % name,
+              [('quantile="%s"' % q, h.percentile(q, counts) or 0) for q in PERCENTILES])
+    for (name, help, label, func) in self._gauges:
+      values = self._gauge_values(label, func)
+      if label is not None:
+        values = [('%s="%s"' % (label, _label(k)), v) for (k, v) in values]
+      _metric(out, name, 'gauge', help, values)
+    return ''.join(out)
+
+  def status(self):
+    ''' Returns the status as a dict, see status_json() '''
+    rates = self.rates()
+    inf = self.taskinf
+    levels = dict(zip(LOG_LEVELS, self._levels.values()))
+    res = {
+      'pid': inf.pid,
+      'cmdline': inf.cmdline,
+      'startup_at': inf.startup_at,
+      'updated_at': inf.updated_at,
+      'files_processed': inf.files_processed,
+      'records_processed': inf.records_processed,
+      'bytes_processed': inf.bytes_processed,
+      'current_file': inf.current_file,
+      'prog_val': inf.prog_val,
+      'prog_max': inf.prog_max,
+      'stopping': self.fstop(),
+      'errors': levels['ERROR'] + levels['FATAL'],
+      'warnings': levels['WARNING'],
+      'rates': dict([(r[0], {'files': r[1], 'records': r[2], 'bytes': r[3]}) for r in rates]),
+      'latency': {},
+      'gauges': {},
+    }
+    for (name, help, h) in self._histograms:
+      (counts, total) = h.values()
+      lat = {'count': sum(counts), 'sum': total}
+      for q in PERCENTILES:
+        lat['p%g' % (q * 100)] = h.percentile(q, counts)
+      res['latency'][name] = lat
+    for (name, help, label, func) in self._gauges:
+      values = self._gauge_values(label, func)
+      if label is None:
+        res['gauges'][name] = None
+        if values:
+          res['gauges'][name] = values[0][1]
+      else:
+        res['gauges'][name] = dict(values)
+    return res
+
+  def status_json(self):
+    ''' Renders status() as JSON '''
+    return json.dumps(self.status(), sort_keys=True)
 
 
 # This is for debug only
 def task_for_test(tracker):
   while not tracker.fstop():
     tracker.log('Put a log message')
-    tracker.update_task_status(files=1, records=2)
-    tracker.update_progress(tracker.taskinf.files_processed, 100)
+    tracker.add_files()
+    tracker.add_records(2)
+    tracker.update_progress(tracker.snapshot().files_processed, 100)
     time.sleep(3)
   pass
 
@@ -1 +1 @@
-__all__ = ['ttypes', 'constants', 'Hbase']
+__all__ = ['ttypes', 'constants', 'Hbase', 'pipeline', 'pool', 'region', 'codec']
@@ -0,0 +1,254 @@
+#
+# Pipelined calls on top of the generated Hbase.Client
+#
+# The generated client splits every call into send_<method> and
+# recv_<method>. PipelinedClient sends up to `depth` calls before it waits
+# for the first reply, so the connection carries requests while the server
+# is still busy with earlier ones.
+#
+# FanoutClient spreads calls over several Thrift gateways, each with its own
+# PipelinedClient.
+#
+
+import time
+
+from collections import deque
+
+from thrift.Thrift import TApplicationException
+from ttypes import *
+from codec import send_encoded
+
+# Exceptions that fail a single request but leave the connection usable
+SERVICE_ERRORS = (IOError, IllegalArgument, TApplicationException)
+
+# Exceptions blaming the data of a request, sending it again won't help
+DATA_ERRORS = (IOError, IllegalArgument)
+
+class PipelinedClient(object):
+  ''' Keeps up to `depth` calls in flight on a connection borrowed from a
+  pool.ConnectionPool.
+
+  A Thrift server handles the calls of one connection in order, so replies
+  are drained in the order the requests were sent. Every request carries a
+  caller supplied tag, completed requests are handed back as a list of
+  (tag, exception) tuples, exception being None on success.
+
+  Exceptions declared by the service (IOError, IllegalArgument) and
+  TApplicationException leave the connection usable and only fail their own
+  request. Any other exception means the transport is out of sync: the
+  connection is returned to the pool as broken and the requests that were
+  not answered yet are sent again on a new connection, up to `retries`
+  times each.
+
+  If given, latency(seconds) is called with the time from sending each
+  request to reading its reply, including the time it waited behind the
+  requests sent before it.
+  '''
+  def __init__(self, pool, depth=4, retries=1, latency=None):
+    self.pool = pool
+    self._conn = None
+    self._depth = max(1, depth)
+    self._retries = retries
+    self._latency = latency
+    self._inflight = deque()  # [tag, method, args, attempts, payload, sent at]
+
+  def outstanding(self):
+    ''' Number of requests sent but not yet answered '''
+    return len(self._inflight)
+
+  def submit(self, tag, method, *args):
+    ''' Sends a call without waiting for its reply.
+    @tag     caller data returned with the result
+    @method  name of a Hbase.Iface method, e.g. 'mutateRows'
+    @args    arguments of the method
+    Returns the requests completed while making room in the pipeline.
+    '''
+    return self._submit([tag, method, args, 0, None, 0])
+
+  def submit_encoded(self, tag, method, payload):
+    ''' Like submit(), with the arguments already serialized, see
+    codec.send_encoded().
+    '''
+    return self._submit([tag, method, None, 0, payload, 0])
+
+  def _submit(self, req):
+    done = []
+    while len(self._inflight) >= self._depth:
+      self._recv_one(done)
+    self._send(req, done)
+    return done
+
+  def drain(self):
+    ''' Waits for all requests in flight. Returns their results. '''
+    done = []
+    while self._inflight:
+      self._recv_one(done)
+    return done
+
+  def close(self):
+    ''' Drains the pipeline and gives the connection back to the pool.
+    Returns the results of the requests that were still in flight.
+    '''
+    done = self.drain()
+    if self._conn is not None:
+      self.pool.put(self._conn)
+      self._conn = None
+    return done
+
+  def _send(self, req, done):
+    try:
+      if self._conn is None:
+        self._conn = self.pool.get()
+      req[5] = time.time()
+      if req[4] is not None:
+        send_encoded(self._conn.client, req[1], req[4])
+      else:
+        getattr(self._conn.client, 'send_' + req[1])(*req[2])
+    except Exception, e:
+      # a half written request leaves the stream out of sync too
+      self._reset(e, [req], done)
+      return
+    self._inflight.append(req)
+
+  def _recv_one(self, done):
+    req = self._inflight.popleft()
+    try:
+      getattr(self._conn.client, 'recv_' + req[1])()
+    except SERVICE_ERRORS, e:
+      self._observe(req)
+      done.append((req[0], e))
+      return
+    except Exception, e:
+      self._reset(e, [req], done)
+      return
+    self._observe(req)
+    done.append((req[0], None))
+
+  def _observe(self, req):
+    if self._latency is not None:
+      self._latency(time.time() - req[5])
+
+  def _reset(self, e, failed, done):
+    ''' Drops the broken connection and sends unanswered requests again '''
+    pending = failed + list(self._inflight)
+    self._inflight.clear()
+    if self._conn is not None:
+      self._conn.broken = True
+      self.pool.put(self._conn)
+      self._conn = None
+    for req in pending:
+      if req[3] >= self._retries:
+        done.append((req[0], e))
+      else:
+        req[3] += 1
+        self._send(req, done)
+
+
+class FanoutClient(object):
+  ''' Spreads calls over several Thrift gateways, one PipelinedClient per
+  gateway.
+
+  A call goes to the healthy gateway with the fewest requests in flight.
+  When a request fails with anything but a service error, its gateway is
+  ejected for `eject_time` seconds and the request is sent again on another
+  gateway it has not tried yet. The last healthy gateway is never ejected,
+  a request that failed on every healthy gateway fails. An ejected gateway
+  is probed with a fresh connection once its time is up and takes requests
+  again if the probe succeeds. Results are handed back as (tag, exception)
+  tuples, like PipelinedClient does. latency is handed to the
+  PipelinedClient of every gateway.
+  '''
+  def __init__(self, pools, depth=4, eject_time=30, latency=None):
+    self._gateways = [PipelinedClient(p, depth, latency=latency) for p in pools]
+    self._eject_time = eject_time
+    self._ejected = {}  # gateway index -> time of next probe
+    self._last_error = None
+    self._next = 0      # ties are broken round robin starting here
+
+  def outstanding(self):
+    ''' Number of requests in flight on all gateways '''
+    n = 0
+    for gw in self._gateways:
+      n += gw.outstanding()
+    return n
+
+  def submit(self, tag, method, *args):
+    ''' Sends a call to the least loaded healthy gateway. Returns the
+    requests completed meanwhile, see PipelinedClient.submit().
+    '''
+    done = []
+    self._route([tag, method, args, [], None], done)
+    return done
+
+  def submit_encoded(self, tag, method, payload):
+    ''' Like submit(), with the arguments already serialized '''
+    done = []
+    self._route([tag, method, None, [], payload], done)
+    return done
+
+  def drain(self):
+    ''' Waits for all requests in flight on all gateways '''
+    done = []
+    while self.outstanding() > 0:
+      for (i, gw) in enumerate(self._gateways):
+        self._collect(i, gw.drain(), done)
+    return done
+
+  def close(self):
+    ''' Drains all gateways and gives their connections back '''
+    done = self.drain()
+    for (i, gw) in enumerate(self._gateways):
+      self._collect(i, gw.close(), done)
+    return done
+
+  def _route(self, req, done):
+    i = self._pick(req[3])
+    if i is None:
+      done.append((req[0], self._last_error or TApplicationException(
+                   TApplicationException.UNKNOWN, 'No healthy Thrift gateway')))
+      return
+    req[3].append(i)
+    gw = self._gateways[i]
+    if req[4] is not None:
+      self._collect(i, gw.submit_encoded(req, req[1], req[4]), done)
+    else:
+      self._collect(i, gw.submit(req, req[1], *req[2]), done)
+
+  def _collect(self, i, results, done):
+    for (req, e) in results:
+      if e is not None and not isinstance(e, SERVICE_ERRORS):
+        # blame the gateway the request went to and try another one
+        self._last_error = e
+        self._eject(req[3][-1])
+        if len(req[3]) < len(self._gateways):
+          self._route(req, done)
+          continue
+      done.append((req[0], e))
+
+  def _eject(self, i):
+    if i in self._ejected or len(self._ejected) + 1 >= len(self._gateways):
+      # keep the last healthy gateway
+      return
+    self._ejected[i] = time.time() + self._eject_time
+
+  def _pick(self, tried):
+    now = time.time()
+    best = None
+    n = len(self._gateways)
+    for k in range(n):
+      i = (self._next + k) % n
+      if i in tried:
+        continue
+      gw = self._gateways[i]
+      if i in self._ejected:
+        if self._ejected[i] > now:
+          continue
+        if not gw.pool.probe():
+          self._ejected[i] = now + self._eject_time
+          continue
+        del self._ejected[i]
+      if best is None or gw.outstanding() < self._gateways[best].outstanding():
+        best = i
+    if best is not None:
+      self._next = (best + 1) % n
+    return best
@@ -0,0 +1,202 @@
+#
+# Thrift connection pool for HBase importers
+#
+# ConnectionPool hands out Hbase.Client connections to one Thrift server.
+# Connections are reused, checked before they are handed out again after
+# being idle for a while, and closed once idle for too long. A connection
+# that has seen a transport error is marked broken and never reused.
+#
+
+import time
+import socket
+import threading
+
+from collections import deque
+from contextlib import contextmanager
+
+from thrift.transport.TSocket import TSocket
+from thrift.transport.TTransport import TBufferedTransport, TTransportException
+from thrift.protocol import TBinaryProtocol
+
+import Hbase
+
+# Exceptions that leave a connection unusable
+TRANSPORT_ERRORS = (TTransportException, socket.error, EOFError)
+
+class Connection(object):
+  ''' A Thrift connection owned by a ConnectionPool '''
+  def __init__(self, host, port, timeout=None):
+    sock = TSocket(host, port)
+    if timeout:
+      sock.setTimeout(timeout * 1000)
+    self.transport = TBufferedTransport(sock)
+    self.transport.open()
+    self.client = Hbase.Client(TBinaryProtocol.TBinaryProtocol(self.transport))
+    self.broken = False
+    self.last_used = time.time()
+
+  def close(self):
+    try:
+      self.transport.close()
+    except Exception, e:
+      pass
+
+
+class ConnectionPool(object):
+  ''' A thread safe pool of connections to a single HBase Thrift server.
+  @host            Thrift server address
+  @port            Thrift server port
+  @maxsize         max number of connections, idle or borrowed
+  @idle_timeout    idle connections older than this(seconds) are closed
+  @check_interval  idle connections older than this(seconds) are pinged
+                   before being handed out
+  @timeout         socket timeout in seconds, None to block forever
+  @probe_timeout   socket timeout of probe() in seconds
+  '''
+  def __init__(self, host, port=9090, maxsize=8, idle_timeout=300, check_interval=30, timeout=None,
+               probe_timeout=5):
+    self.host = host
+    self.port = port
+    self._probe_timeout = probe_timeout
+    self._maxsize = max(1, maxsize)
+    self._idle_timeout = idle_timeout
+    self._check_interval = check_interval
+    self._timeout = timeout
+    self._idle = deque()   # most recently used on the right
+    self._size = 0         # idle + borrowed connections
+    self._cond = threading.Condition()
+    self._closed = False
+
+  def get(self, wait=True):
+    ''' Borrows a connection. Blocks while maxsize connections are borrowed,
+    unless wait is False in which case None is returned.
+    '''
+    with self._cond:
+      while True:
+        if self._closed:
+          raise TTransportException(TTransportException.NOT_OPEN, 'Connection pool closed')
+        self._evict()
+        if self._idle:
+          conn = self._idle.pop()
+          break
+        if self._size < self._maxsize:
+          self._size += 1
+          conn = None
+          break
+        if not wait:
+          return None
+        self._cond.wait()
+
+    if conn is None:
+      try:
+        return Connection(self.host, self.port, self._timeout)
+      except Exception, e:
+        self._discard(None)
+        raise
+    if time.time() - conn.last_used > self._check_interval and not self._healthy(conn):
+      self._discard(conn)
+      return self.get(wait)
+    return conn
+
+  def put(self, conn):
+    ''' Returns a borrowed connection. Broken connections are closed. '''
+    if conn.broken or self._closed:
+      self._discard(conn)
+      return
+    conn.last_used = time.time()
+    with self._cond:
+      self._idle.append(conn)
+      self._cond.notify()
+
+  @contextmanager
+  def connection(self):
+    ''' Borrows a connection for the with block. A transport error raised
+    inside the block marks the connection broken.
+    '''
+    conn = self.get()
+    try:
+      yield conn
+    except TRANSPORT_ERRORS:
+      conn.broken = True
+      raise
+    finally:
+      self.put(conn)
+
+  def probe(self):
+    ''' Checks whether the server accepts a new connection and answers a
+    call on it. Used to decide whether an ejected server is back. Gives up
+    after probe_timeout seconds, as it runs on the write path.
+    '''
+    try:
+      conn = Connection(self.host, self.port, self._probe_timeout)
+    except Exception, e:
+      return False
+    try:
+      return self._healthy(conn)
+    finally:
+      conn.close()
+
+  def client(self):
+    ''' Returns a Hbase.Client look-alike that runs every call on a pooled
+    connection and retries a call once on a fresh connection if the
+    transport breaks.
+    '''
+    return PooledClient(self)
+
+  def close(self):
+    ''' Closes idle connections. Borrowed ones are closed when returned. '''
+    with self._cond:
+      self._closed = True
+      idle = list(self._idle)
+      self._idle.clear()
+      self._size -= len(idle)
+      self._cond.notify_all()
+    for conn in idle:
+      conn.close()
+
+  def _evict(self):
+    ''' Closes connections idle for longer than idle_timeout, holding the lock '''
+    deadline = time.time() - self._idle_timeout
+    while self._idle and self._idle[0].last_used < deadline:
+      self._idle.popleft().close()
+      self._size -= 1
+
+  def _discard(self, conn):
+    if conn is not None:
+      conn.close()
+    with self._cond:
+      self._size -= 1
+      self._cond.notify()
+
+  def _healthy(self, conn):
+    if not conn.transport.isOpen():
+      return False
+    try:
+      conn.client.getTableNames()
+    except Exception, e:
+      return False
+    return True
+
+
+class PooledClient(object):
+  ''' Proxy of Hbase.Client that borrows a connection from the pool for every
+  call. If the transport breaks, the call is retried once on a fresh
+  connection. Writes to HBase are idempotent puts, so a retried mutation
+  that had already been applied does no harm.
+  '''
+  def __init__(self, pool):
+    self._pool = pool
+
+  def __getattr__(self, name):
+    def call(*args):
+      for attempt in (0, 1):
+        conn = self._pool.get()
+        try:
+          return getattr(conn.client, name)(*args)
+        except TRANSPORT_ERRORS:
+          conn.broken = True
+          if attempt:
+            raise
+        finally:
+          self._pool.put(conn)
+    return call
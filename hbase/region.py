@@ -0,0 +1,94 @@
+#
+# Region aware grouping of rows
+#
+# RegionRouter asks the Thrift server once for the regions of a table and
+# maps row keys to regions with a binary search over the region start keys.
+# Rows of a mutateRows call that all fall in one region are written by a
+# single region server. The router is shared by the threads of an import,
+# the map is reloaded under a lock and published in one assignment.
+#
+
+import time
+import bisect
+import threading
+
+from ttypes import *
+
+# Fragments of HBase exception names telling that a region has moved
+MOVED_ERRORS = ('NotServingRegion', 'RegionMoved', 'WrongRegion',
+                'RegionOpening', 'RegionServerStopped', 'RegionTooBusy')
+
+class RegionRouter(object):
+  ''' Maps row keys of a table to its regions.
+  @client          Hbase.Client or pool.PooledClient used for getTableRegions
+  @table           table name
+  @retry_interval  seconds to wait before asking again after a failed
+                   getTableRegions call, all rows map to one region meanwhile
+  '''
+  def __init__(self, client, table, retry_interval=60):
+    self._client = client
+    self._table = table
+    self._retry_interval = retry_interval
+    self._starts = None      # sorted region start keys, None until loaded
+    self._retry_at = 0       # time the map is stale at, 0 if it is not
+    self._lock = threading.RLock()
+
+  def refresh(self):
+    ''' Reloads the region map. Returns the number of regions. '''
+    with self._lock:
+      retry_at = 0
+      try:
+        regions = self._client.getTableRegions(self._table)
+        starts = sorted([r.startKey or '' for r in regions])
+      except Exception, e:
+        starts = []
+        retry_at = time.time() + self._retry_interval
+      # the first region starts at the empty key
+      if not starts or starts[0] != '':
+        starts.insert(0, '')
+      # readers take the list without the lock, publish it whole
+      self._starts = starts
+      self._retry_at = retry_at
+      return len(starts)
+
+  def invalidate(self):
+    ''' Marks the region map stale, it is reloaded on next use. Until then
+    rows map to the old regions.
+    '''
+    self._retry_at = time.time()
+
+  def _stale(self):
+    return self._starts is None or (self._retry_at and time.time() >= self._retry_at)
+
+  def _current(self):
+    ''' Returns the start keys, reloading them first if stale. Threads
+    finding the map stale at once reload it only once.
+    '''
+    if self._stale():
+      with self._lock:
+        if self._stale():
+          self.refresh()
+    return self._starts
+
+  def region_of(self, row):
+    ''' Returns the index of the region holding row '''
+    return bisect.bisect_right(self._current(), row) - 1
+
+  def start_keys(self):
+    ''' Returns the sorted start keys of the regions, e.g. for mapping rows
+    to regions in another process.
+    '''
+    return list(self._current())
+
+  def check_error(self, e):
+    ''' Invalidates the region map if exception e says that a region has
+    moved. Returns True in that case.
+    '''
+    if not isinstance(e, IOError):
+      return False
+    msg = e.message or ''
+    for s in MOVED_ERRORS:
+      if s in msg:
+        self.invalidate()
+        return True
+    return False
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# This file is part of tweetproj
+#
+# Incremental reader of a JSON array. The elements of the top level array
+# are decoded one at a time from a file-like object, e.g. an open file or a
+# RarExtFile, so that memory use depends on the largest element rather
+# than on the size of the file.
+#
+# A RarExtFile is read with iter_chunks(), which fills one reused buffer
+# with readinto() and checks the CRC on the way. The decoder works on str,
+# so each chunk is copied once, into the parse buffer.
+
+import re
+import json
+
+_WS = ' \t\n\r'
+_NUMBER = '-0123456789'
+_DELIM = re.compile(r'[\s,\]]')
+
+class ArrayReader(object):
+  ''' Iterates over the elements of a JSON array read from a file object.
+  @fp          file-like object with read(n) returning str, or with
+               iter_chunks(n) like RarExtFile
+  @chunk_size  bytes read at a time
+  Raises ValueError on malformed input, like json.load().
+  '''
+  def __init__(self, fp, chunk_size=64*1024):
+    self._chunks = _chunks_of(fp, chunk_size)
+    self._decoder = json.JSONDecoder()
+    self._buf = ''
+    self._pos = 0         # parse position within _buf
+    self._base = 0        # offset of _buf within the stream
+    self._eof = False
+    self.count = 0        # number of elements decoded so far
+
+  @property
+  def consumed(self):
+    ''' Number of bytes of the stream parsed so far '''
+    return self._base + self._pos
+
+  def __iter__(self):
+    if self._next_char() != '[':
+      self._fail('Expecting [')
+    self._pos += 1
+    c = self._next_char()
+    if c == ']':
+      self._pos += 1
+    else:
+      while True:
+        yield self._decode()
+        self.count += 1
+        c = self._next_char()
+        self._pos += 1
+        if c == ']':
+          break
+        if c != ',':
+          self._fail('Expecting , delimiter')
+    if self._next_char() is not None:
+      self._fail('Extra data')
+
+  def _fill(self, need=0):
+    ''' Reads at least one more chunk, and at least need bytes so that
+    retries of a long element stay linear. Returns False at the end of the
+    stream.
+    '''
+    if self._eof:
+      return False
+    parts = [self._buf[self._pos:]]
+    self._base += self._pos
+    self._pos = 0
+    got = 0
+    while got == 0 or got < need:
+      chunk = next(self._chunks, None)
+      if chunk is None:
+        self._eof = True
+        break
+      if isinstance(chunk, memoryview):
+        chunk = chunk.tobytes()
+      parts.append(chunk)
+      got += len(chunk)
+    self._buf = ''.join(parts)
+    return got > 0
+
+  def _next_char(self):
+    ''' Skips whitespace, returns the next character or None at the end '''
+    while True:
+      n = len(self._buf)
+      while self._pos < n and self._buf[self._pos] in _WS:
+        self._pos += 1
+      if self._pos < n:
+        return self._buf[self._pos]
+      if not self._fill():
+        return None
+
+  def _decode(self):
+    if self._next_char() is None:
+      self._fail('Expecting object')
+    # a number ends at the next delimiter, which has to be buffered or it
+    # might go on in the next chunk
+    if self._buf[self._pos] in _NUMBER:
+      while not _DELIM.search(self._buf, self._pos) and self._fill(len(self._buf) - self._pos):
+        pass
+    while True:
+      try:
+        (obj, end) = self._decoder.raw_decode(self._buf, self._pos)
+      except ValueError, e:
+        # the element may just be cut off at the end of the buffer
+        if self._fill(len(self._buf) - self._pos):
+          continue
+        raise
+      self._pos = end
+      return obj
+
+  def _fail(self, msg):
+    raise ValueError('%s: char %d' % (msg, self.consumed))
+
+
+def _chunks_of(fp, size):
+  ''' Returns an iterator over the data of fp in chunks '''
+  if hasattr(fp, 'iter_chunks'):
+    return fp.iter_chunks(size)
+  return _read_chunks(fp, size)
+
+def _read_chunks(fp, size):
+  while True:
+    data = fp.read(size)
+    if not data:
+      break
+    yield data
@@ -0,0 +1,164 @@
+#!/usr/bin/python
+# This file is part of tweetproj
+#
+# Read-ahead of rar archives. While one archive is imported, a background
+# thread parses the headers of the next archives of the listing and
+# extracts their first entries into memory, so that extracting the next
+# archive overlaps with writing the current one. Extracted data is held
+# within a memory budget, the rest of an archive is extracted as usual once
+# the importer gets to it.
+
+import threading
+
+import rarfile
+
+from threading import Thread
+
+class PrefetchedArchive(object):
+  ''' An archive opened ahead of the importer.
+  @path   archive path
+  @rf     RarFile with headers parsed, None if opening failed
+  @error  exception raised while opening or extracting, if any
+  @data   list of (RarInfo, data) of the leading entries extracted ahead,
+          see ArchivePrefetcher.release()
+  '''
+  def __init__(self, path, index):
+    self.path = path
+    self.index = index
+    self.rf = None
+    self.error = None
+    self.data = []
+    self.stopped = False
+    self.dropped = False
+    self.done = False
+
+
+class ArchivePrefetcher(object):
+  ''' Opens archives ahead of the importer.
+  @paths   archive paths in the order they are imported
+  @select  callable(rf, path) returning the RarInfo of the entries to
+           extract, in archive order
+  @ahead   number of archives opened ahead of the one taken last
+  @budget  max bytes of extracted data held
+  '''
+  def __init__(self, paths, select, ahead=1, budget=256*1024*1024):
+    self._paths = list(paths)
+    self._index = dict([(p, i) for (i, p) in enumerate(self._paths)])
+    self._select = select
+    self._ahead = max(1, ahead)
+    self._budget = budget
+    self._used = 0
+    self._taken = -1        # index of the archive taken last
+    self._pending = {}      # path -> PrefetchedArchive, not taken yet
+    self._closed = False
+    self._cond = threading.Condition()
+    self._thread = None
+
+  def start(self):
+    self._thread = Thread(target=self._run, name='prefetch')
+    self._thread.setDaemon(True)
+    self._thread.start()
+    return self
+
+  def take(self, path):
+    ''' Stops read-ahead of archive path and returns its PrefetchedArchive,
+    or None if it has not been opened ahead. Archives before path that were
+    never taken are dropped.
+    '''
+    with self._cond:
+      idx = self._index.get(path)
+      if idx is None:
+        return None
+      self._taken = max(self._taken, idx)
+      for pre in self._pending.values():
+        if pre.index < idx:
+          self._drop(pre)
+      pre = self._pending.pop(path, None)
+      self._cond.notify_all()
+      if pre is None:
+        return None
+      pre.stopped = True
+      while not pre.done:
+        self._cond.wait()
+      return pre
+
+  def held(self):
+    ''' Returns (number of archives opened ahead, bytes of data held) '''
+    with self._cond:
+      return (len(self._pending), self._used)
+
+  def release(self, nbytes):
+    ''' Gives back the budget of an entry of PrefetchedArchive.data once
+    the importer is done with it.
+    '''
+    with self._cond:
+      self._used -= nbytes
+      self._cond.notify_all()
+
+  def close(self):
+    with self._cond:
+      self._closed = True
+      for pre in self._pending.values():
+        self._drop(pre)
+      self._cond.notify_all()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def _drop(self, pre):
+    ''' Drops an archive that will not be taken, holding the lock '''
+    pre.stopped = True
+    pre.dropped = True
+    for (inf, data) in pre.data:
+      self._used -= inf.file_size
+    pre.data = []
+    self._pending.pop(pre.path, None)
+
+  def _run(self):
+    for (idx, path) in enumerate(self._paths):
+      with self._cond:
+        while not self._closed and idx > self._taken + self._ahead:
+          self._cond.wait()
+        if self._closed:
+          return
+        if idx <= self._taken:
+          # the importer got there first
+          continue
+        pre = PrefetchedArchive(path, idx)
+        self._pending[path] = pre
+      try:
+        self._fetch(pre)
+      except Exception, e:
+        pre.error = e
+      with self._cond:
+        pre.done = True
+        self._cond.notify_all()
+
+  def _fetch(self, pre):
+    pre.rf = rarfile.RarFile(pre.path)
+    infos = self._select(pre.rf, pre.path)
+    stream = pre.rf.iterstream(infos)
+    try:
+      for (inf, fp) in stream:
+        with self._cond:
+          while not pre.stopped and self._used + inf.file_size > self._budget \
+                and inf.file_size <= self._budget:
+            self._cond.wait()
+          if pre.stopped or inf.file_size > self._budget:
+            return
+          self._used += inf.file_size
+        try:
+          data = fp.read()
+        except:
+          # give the budget back, the error ends the archive
+          with self._cond:
+            self._used -= inf.file_size
+            self._cond.notify_all()
+          raise
+        with self._cond:
+          if pre.dropped:
+            self._used -= inf.file_size
+            return
+          pre.data.append((inf, data))
+    finally:
+      stream.close()
@@ -22,7 +22,8 @@ is made as zipfile like as possible.
 Basic logic:
  - Parse archive structure with Python.
  - Extract non-compressed files with Python
- - Extract compressed files with unrar.
+ - Extract compressed files in-process with unrar library, if found,
+   otherwise with unrar.
  - Optionally write compressed data to temp file to speed up unrar,
    otherwise it needs to scan whole archive on each execution.
 
@@ -44,6 +45,10 @@ here they are with defaults, and reason to change it::
     # Set to full path of unrar.exe if it is not in PATH
     rarfile.UNRAR_TOOL = "unrar"
 
+    # Set to full path of unrar library if it is not found
+    # by ctypes.util.find_library(), '' to always use unrar tool
+    rarfile.UNRAR_LIB = None
+
     # Set to 0 if you don't look at comments and want to
     # avoid wasting time for parsing them
     rarfile.NEED_COMMENTS = 1
@@ -73,7 +78,7 @@ __all__ = ['is_rarfile', 'RarInfo', 'RarFile', 'RarExtFile']
 ## Imports and compat - support both Python 2.x and 3.x
 ##
 
-import sys, os, struct
+import sys, os, struct, threading, marshal, mmap
 from struct import pack, unpack
 from binascii import crc32
 from tempfile import mkstemp
@@ -95,9 +100,13 @@ except ImportError:
 if sys.hexversion < 0x3000000:
     # prefer 3.x behaviour
     range = xrange
+    # zero-copy slices for mmap parsing
+    _have_buffer = 1
     # py2.6 has broken bytes()
     def bytes(s, enc):
         return str(s)
+else:
+    _have_buffer = 0
 
 # see if compat bytearray() is needed
 try:
@@ -113,6 +122,19 @@ except NameError:
         def decode(self, *args):
             return self.arr.tostring().decode(*args)
 
+# queue module was renamed in 3.x
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+# ctypes is needed for unrar library
+try:
+    import ctypes, ctypes.util
+    _have_ctypes = 1
+except ImportError:
+    _have_ctypes = 0
+
 # Optimized .readinto() requires memoryview
 try:
     memoryview
@@ -157,6 +179,10 @@ TRY_ENCODINGS = ('utf8', 'utf-16le')
 # 'unrar', 'rar' or full path to either one
 UNRAR_TOOL = "unrar"
 
+# Path of unrar library (libunrar.so, unrar.dll) for extracting
+# in-process, None searches for it, '' disables it.
+UNRAR_LIB = None
+
 # Command line args to use for opening file for reading.
 OPEN_ARGS = ('p', '-inul')
 
@@ -189,6 +215,19 @@ USE_DATETIME = 0
 # Use '/' to be similar with zipfile.
 PATH_SEP = '\\'
 
+# Directory for cached header indexes, None disables the cache.
+# An index is used only while size and mtime of all volumes match.
+INDEX_DIR = None
+
+# Max number of derived RAR3 keys kept for reuse, shared
+# by all archives.
+S2K_CACHE_SIZE = 64
+
+# Parse headers from a memory-mapped file, without a read() call
+# and copy per header.  Archives with encrypted headers are parsed
+# from the file as usual.  Used only on Python 2.x.
+USE_MMAP = 1
+
 ##
 ## rar constants
 ##
@@ -352,14 +391,14 @@ class RarInfo(object):
         Optional time field: last access time, with float seconds.
     @ivar arctime:
         Optional time field: archival time, with float seconds.
+
+    Filename and time fields are decoded on first access.
     '''
 
     __slots__ = (
         # zipfile-compatible fields
-        'filename',
         'file_size',
         'compress_size',
-        'date_time',
         'comment',
         'CRC',
         'volume',
@@ -373,12 +412,15 @@ class RarInfo(object):
         'type',
         'flags',
 
-        # optional extended time fields
-        # tuple where the sec is float, or datetime().
-        'mtime', # same as .date_time
-        'ctime',
-        'atime',
-        'arctime',
+        # undecoded fields, see filename and date_time
+        '_uname',   # unicode-encoded name or None
+        '_charset',
+        '_dostime',
+        '_exttime', # extended time data or None
+
+        # decoded fields
+        '_filename',
+        '_times',   # (date_time, mtime, ctime, atime, arctime)
 
         # RAR internals
         'name_size',
@@ -393,6 +435,46 @@ class RarInfo(object):
         'volume_file',
     )
 
+    def _get_filename(self):
+        try:
+            return self._filename
+        except AttributeError:
+            self._filename = _decode_filename(self)
+            return self._filename
+
+    def _set_filename(self, val):
+        self._filename = val
+
+    filename = property(_get_filename, _set_filename)
+
+    def _get_times(self):
+        try:
+            return self._times
+        except AttributeError:
+            self._times = _decode_times(self._dostime, self._exttime)
+            return self._times
+
+    def _time_field(idx):
+        def get(self):
+            return self._get_times()[idx]
+        def set(self, val):
+            try:
+                times = list(self._get_times())
+            except AttributeError:
+                times = [None] * 5
+            times[idx] = val
+            self._times = tuple(times)
+        return property(get, set)
+
+    date_time = _time_field(0)
+    # optional extended time fields
+    # tuple where the sec is float, or datetime().
+    mtime = _time_field(1) # same as .date_time
+    ctime = _time_field(2)
+    atime = _time_field(3)
+    arctime = _time_field(4)
+    del _time_field
+
     def isdir(self):
         '''Returns True if the entry is a directory.'''
         if self.type == RAR_BLOCK_FILE:
@@ -425,7 +507,7 @@ class RarFile(object):
         self._info_callback = info_callback
 
         self._info_list = []
-        self._info_map = {}
+        self._info_map = None
         self._needs_password = False
         self._password = None
         self._crc_check = crc_check
@@ -437,6 +519,9 @@ class RarFile(object):
 
         self._parse()
 
+    # index format version, bump on any change of the stored fields
+    _INDEX_MAGIC = bytes("RarIdx02", 'ascii')
+
     def setpassword(self, password):
         '''Sets the password to use when extracting.'''
         self._password = password
@@ -467,11 +552,17 @@ class RarFile(object):
         else:
             fname2 = fname.replace("/", "\\")
 
+        # name lookup decodes all filenames, build it on first use
+        info_map = self._info_map
+        if info_map is None:
+            info_map = dict([(h.filename, h) for h in self._info_list])
+            self._info_map = info_map
+
         try:
-            return self._info_map[fname]
+            return info_map[fname]
         except KeyError:
             try:
-                return self._info_map[fname2]
+                return info_map[fname2]
             except KeyError:
                 raise NoRarEntry("No such file: "+fname)
 
@@ -512,25 +603,13 @@ class RarFile(object):
         else:
             psw = None
 
-        # is temp write usable?
-        if not USE_EXTRACT_HACK or not self._main:
-            use_hack = 0
-        elif self._main.flags & (RAR_MAIN_SOLID | RAR_MAIN_PASSWORD):
-            use_hack = 0
-        elif inf.flags & (RAR_FILE_SPLIT_BEFORE | RAR_FILE_SPLIT_AFTER):
-            use_hack = 0
-        elif inf.file_size > HACK_SIZE_LIMIT:
-            use_hack = 0
-        else:
-            use_hack = 1
+        # in-process extraction
+        backend = self._backend([inf], psw)
+        if backend:
+            return backend.open(self, inf, psw)
 
-        # now extract
-        if inf.compress_type == RAR_M0 and (inf.flags & RAR_FILE_PASSWORD) == 0:
-            return self._open_clear(inf)
-        elif use_hack:
-            return self._open_hack(inf, psw)
-        else:
-            return self._open_unrar(self.rarfile, inf, psw)
+        # now extract with unrar
+        return self._open_tool(inf, psw)
 
     def read(self, fname, psw = None):
         """Return uncompressed data for archive entry.
@@ -547,6 +626,184 @@ class RarFile(object):
         finally:
             f.close()
 
+    def iterstream(self, members = None, psw = None):
+        """Iterate over archive entries, yielding (RarInfo, file object).
+
+        Compressed entries are extracted by a single unrar process
+        for the whole archive, its output is split into entries by
+        their sizes.  Entries are yielded in archive order.  A file
+        object is valid until the next entry is requested, unread
+        data is skipped then.  The objects are not seekable.
+
+        Volume archives, archives without compressed or encrypted
+        entries, and encrypted entries without a password are handled
+        with open() for each entry.
+
+        @param members: list of filenames or RarInfo instances,
+                        default all files in archive.
+        @param psw: password to use for extracting.
+        """
+
+        psw = psw or self._password
+        wanted = self._select(members)
+        order = {}
+        for i, inf in enumerate(self._info_list):
+            order[id(inf)] = i
+
+        # in-process extraction
+        backend = self._backend(wanted, psw)
+        if backend:
+            for inf, f in backend.iterstream(self, wanted, psw):
+                yield inf, f
+            return
+
+        # is single unrar run usable?
+        use_pipe = 1
+        if self._main and self._main.flags & RAR_MAIN_VOLUME:
+            use_pipe = 0
+        elif self._needs_password and psw is None:
+            use_pipe = 0
+
+        if not use_pipe:
+            for inf in wanted:
+                f = self.open(inf, 'r', psw)
+                try:
+                    yield inf, f
+                finally:
+                    f.close()
+            return
+
+        cmd = [UNRAR_TOOL] + list(OPEN_ARGS)
+        if psw is not None:
+            cmd.append("-p" + psw)
+        cmd.append(self.rarfile)
+        proc = custom_popen(cmd)
+        if proc.stdin:
+            proc.stdin.close()
+        try:
+            pos = 0
+            for inf in wanted:
+                # skip output of entries in between
+                idx = order[id(inf)]
+                while pos < idx:
+                    _skip_stream(proc.stdout, self._info_list[pos].file_size)
+                    pos += 1
+                pos = idx + 1
+
+                f = StreamReader(self, inf, proc.stdout)
+                try:
+                    yield inf, f
+                finally:
+                    f.close()
+        finally:
+            proc.stdout.close()
+            proc.wait()
+
+    def _backend(self, infos, psw):
+        """Return first of DECOMPRESSORS that can extract all infos."""
+        for backend in DECOMPRESSORS:
+            for inf in infos:
+                if not backend.accepts(self, inf, psw):
+                    break
+            else:
+                return backend
+        return None
+
+    def iterextract(self, members = None, psw = None, workers = 4, ordered = 0):
+        """Extract entries concurrently, yielding (RarInfo, data).
+
+        Up to workers entries are extracted at once, each one with
+        read().  At most 2*workers entries are extracted ahead of the
+        consumer.  Entries are yielded in completion order, or in
+        archive order if ordered is set.  If an entry fails, the
+        remaining work is cancelled and its error is raised once the
+        entry is due.
+
+        Entries of solid archives depend on each other, so these are
+        extracted in a single pass with iterstream() instead.
+
+        @param members: list of filenames or RarInfo instances,
+                        default all files in archive.
+        @param psw: password to use for extracting.
+        @param workers: max number of entries extracted at once.
+        @param ordered: yield entries in archive order.
+        """
+
+        wanted = self._select(members)
+        solid = self._main and self._main.flags & RAR_MAIN_SOLID
+        if solid or workers < 2 or len(wanted) < 2:
+            for inf, f in self.iterstream(wanted, psw):
+                yield inf, f.read()
+            return
+
+        todo = list(enumerate(wanted))
+        todo.reverse()
+        lock = threading.Lock()
+        window = threading.Semaphore(2 * workers)
+        results = Queue()
+        stop = []
+
+        def work():
+            while 1:
+                window.acquire()
+                lock.acquire()
+                try:
+                    if stop or not todo:
+                        window.release()
+                        return
+                    idx, inf = todo.pop()
+                finally:
+                    lock.release()
+                try:
+                    results.put((idx, inf, self.read(inf, psw), None))
+                except Exception:
+                    results.put((idx, inf, None, sys.exc_info()[1]))
+
+        threads = []
+        for i in range(min(workers, len(wanted))):
+            th = threading.Thread(target = work)
+            th.setDaemon(True)
+            th.start()
+            threads.append(th)
+
+        try:
+            done = {}
+            nextidx = 0
+            for i in range(len(wanted)):
+                res = results.get()
+                if ordered:
+                    done[res[0]] = res
+                    ready = []
+                    while nextidx in done:
+                        ready.append(done.pop(nextidx))
+                        nextidx += 1
+                else:
+                    ready = [res]
+                for idx, inf, data, err in ready:
+                    if err is not None:
+                        raise err
+                    yield inf, data
+                    window.release()
+        finally:
+            lock.acquire()
+            stop.append(1)
+            lock.release()
+            for th in threads:
+                window.release()
+            for th in threads:
+                th.join()
+
+    def _select(self, members):
+        """Return RarInfo of members in archive order, default all files."""
+        if members is None:
+            return [inf for inf in self._info_list if not inf.isdir()]
+        order = {}
+        for i, inf in enumerate(self._info_list):
+            order[id(inf)] = i
+        wanted = [self.getinfo(m) for m in members]
+        wanted.sort(key = lambda inf: order[id(inf)])
+        return wanted
+
     def close(self):
         """Release open resources."""
         pass
@@ -608,7 +865,6 @@ class RarFile(object):
         if item.type == RAR_BLOCK_FILE:
             # use only first part
             if (item.flags & RAR_FILE_SPLIT_BEFORE) == 0:
-                self._info_map[item.filename] = item
                 self._info_list.append(item)
                 # remember if any items require password
                 if item.needs_password():
@@ -641,19 +897,122 @@ class RarFile(object):
 
     # read rar
     def _parse(self):
+        if self._load_index():
+            return
         self._fd = None
+        self._volumes = [self.rarfile]
         try:
-            self._parse_real()
+            try:
+                self._parse_real(USE_MMAP and _have_buffer)
+            except _NeedFileParse:
+                self._fd.close()
+                self._fd = None
+                self._info_list = []
+                self._info_map = None
+                self._main = None
+                self._needs_password = False
+                self.comment = None
+                self._volumes = [self.rarfile]
+                self._parse_real(0)
         finally:
             if self._fd:
                 self._fd.close()
                 self._fd = None
+        self._save_index()
+
+    # cached header index
+    def _index_usable(self):
+        return (INDEX_DIR and not self._info_callback and not self._password
+                and not USE_DATETIME)
+
+    def _index_file(self):
+        path = os.path.abspath(self.rarfile)
+        if not isinstance(path, type(EMPTY)):
+            path = path.encode('utf8')
+        name = '%s-%08x.idx' % (os.path.basename(self.rarfile), crc32(path) & 0xFFFFFFFF)
+        return os.path.join(INDEX_DIR, name)
+
+    def _index_key(self, volumes):
+        vols = []
+        for vol in volumes:
+            st = os.stat(vol)
+            vols.append((vol, st.st_size, st.st_mtime))
+        return (os.path.abspath(self.rarfile), self._charset, PATH_SEP,
+                NEED_COMMENTS, UNICODE_COMMENTS, REPORT_BAD_HEADER, tuple(vols))
+
+    def _load_index(self):
+        """Restore parsed headers from index, return True on success."""
+        if not self._index_usable():
+            return False
+        try:
+            f = open(self._index_file(), 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            if data[:len(self._INDEX_MAGIC)] != self._INDEX_MAGIC:
+                return False
+            key, main, comment, needs_psw, items = marshal.loads(data[len(self._INDEX_MAGIC):])
+            if key != self._index_key([v[0] for v in key[-1]]):
+                return False
+            main = _restore_infos(main)
+            items = _restore_infos(items)
+        except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+            return False
+
+        self._main = main[0]
+        self.comment = comment
+        self._needs_password = needs_psw
+        self._info_list = items
+        self._info_map = None
+        list(map(RarInfo.__dict__['_charset'].__set__, items,
+                 [self._charset] * len(items)))
+        return True
+
+    def _save_index(self):
+        """Write parsed headers to index, errors are ignored."""
+        if not self._index_usable() or not self._main:
+            return
+        if self._main.flags & RAR_MAIN_PASSWORD:
+            # never store decrypted headers
+            return
+
+        fn = self._index_file()
+        tmp = fn + '.%d.tmp' % os.getpid()
+        try:
+            data = marshal.dumps((self._index_key(self._volumes), _dump_infos([self._main]),
+                                  self.comment, self._needs_password,
+                                  _dump_infos(self._info_list)), 2)
+            if not os.path.isdir(INDEX_DIR):
+                os.makedirs(INDEX_DIR)
+            f = open(tmp, 'wb')
+            try:
+                f.write(self._INDEX_MAGIC + data)
+            finally:
+                f.close()
+            if os.path.exists(fn):
+                os.remove(fn)
+            os.rename(tmp, fn)
+        except (IOError, OSError, ValueError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def _open_volume(self, volfile, mapped):
+        if mapped:
+            try:
+                return _MappedFile(volfile)
+            except (EnvironmentError, ValueError):
+                # empty file or mmap not possible
+                pass
+        return open(volfile, "rb")
 
-    def _parse_real(self):
-        fd = open(self.rarfile, "rb")
+    def _parse_real(self, mapped = 0):
+        fd = self._open_volume(self.rarfile, mapped)
         self._fd = fd
         id = fd.read(len(RAR_ID))
-        if id != RAR_ID:
+        if id[:] != RAR_ID:
             raise NotRarFile("Not a Rar archive: "+self.rarfile)
 
         volume = 0  # first vol (.rar) is 0
@@ -670,7 +1029,8 @@ class RarFile(object):
                     volume += 1
                     volfile = self._next_volname(volfile)
                     fd.close()
-                    fd = open(volfile, "rb")
+                    fd = self._open_volume(volfile, mapped)
+                    self._volumes.append(volfile)
                     self._fd = fd
                     more_vols = 0
                     endarc = 0
@@ -704,22 +1064,19 @@ class RarFile(object):
 
             # store it
             self._process_entry(h)
+            # needed only for parsing, may point into the map
+            del h.header_data
 
             # go to next header
             if h.add_size > 0:
                 fd.seek(h.file_offset + h.add_size, 0)
 
     # AES encrypted headers
-    _last_aes_key = (None, None, None) # (salt, key, iv)
     def _decrypt_header(self, fd):
         if not _have_crypto:
             raise NoCrypto('Cannot parse encrypted headers - no crypto')
         salt = fd.read(8)
-        if self._last_aes_key[0] == salt:
-            key, iv = self._last_aes_key[1:]
-        else:
-            key, iv = rar3_s2k(self._password, salt)
-            self._last_aes_key = (salt, key, iv)
+        key, iv = _cached_s2k(self._password, salt)
         return HeaderDecrypt(fd, key, iv)
 
     # read single header
@@ -729,7 +1086,14 @@ class RarFile(object):
             if self._main and self._main.flags & RAR_MAIN_PASSWORD:
                 if not self._password:
                     return
-                fd = self._decrypt_header(fd)
+                if isinstance(fd, _MappedFile):
+                    raise _NeedFileParse()
+                # header starts with the salt
+                ofs = fd.tell()
+                h = self._parse_block_header(self._decrypt_header(fd))
+                if h:
+                    h.header_offset = ofs
+                return h
 
             # now read actual header
             return self._parse_block_header(fd)
@@ -741,25 +1105,37 @@ class RarFile(object):
     # common header
     def _parse_block_header(self, fd):
         h = RarInfo()
-        h.header_offset = fd.tell()
         h.comment = None
 
-        # read and parse base header
-        buf = fd.read(S_BLK_HDR.size)
-        if not buf:
-            return None
-        t = S_BLK_HDR.unpack_from(buf)
+        if fd.__class__ is _MappedFile:
+            # take full header straight from the map
+            ofs = h.header_offset = fd.pos
+            if ofs >= fd.size:
+                return None
+            t = S_BLK_HDR.unpack_from(fd.mm, ofs)
+            if t[3] > S_BLK_HDR.size:
+                h.header_data = buffer(fd.mm, ofs, t[3])
+            else:
+                h.header_data = buffer(fd.mm, ofs, S_BLK_HDR.size)
+            fd.pos = h.file_offset = ofs + len(h.header_data)
+        else:
+            # read and parse base header
+            h.header_offset = fd.tell()
+            buf = fd.read(S_BLK_HDR.size)
+            if not buf:
+                return None
+            t = S_BLK_HDR.unpack_from(buf)
+
+            # read full header
+            if t[3] > S_BLK_HDR.size:
+                h.header_data = buf + fd.read(t[3] - S_BLK_HDR.size)
+            else:
+                h.header_data = buf
+            h.file_offset = fd.tell()
         h.header_crc, h.type, h.flags, h.header_size = t
         h.header_base = S_BLK_HDR.size
         pos = S_BLK_HDR.size
 
-        # read full header
-        if h.header_size > S_BLK_HDR.size:
-            h.header_data = buf + fd.read(h.header_size - S_BLK_HDR.size)
-        else:
-            h.header_data = buf
-        h.file_offset = fd.tell()
-
         # unexpected EOF?
         if len(h.header_data) != h.header_size:
             if REPORT_BAD_HEADER:
@@ -796,9 +1172,9 @@ class RarFile(object):
 
         # check crc
         if h.type == RAR_BLOCK_OLD_SUB:
-            crcdat = h.header_data[2:] + fd.read(h.add_size)
+            crcdat = h.header_data[2:] + fd.read(h.add_size)[:]
         else:
-            crcdat = h.header_data[2:h.header_base]
+            crcdat = _subview(h.header_data, 2, h.header_base)
 
         calc_crc = crc32(crcdat) & 0xFFFF
 
@@ -829,7 +1205,7 @@ class RarFile(object):
         h.file_size = fld[1]
         h.host_os = fld[2]
         h.CRC = fld[3]
-        h.date_time = parse_dos_time(fld[4])
+        h._dostime = fld[4]
         h.extract_version = fld[5]
         h.compress_type = fld[6]
         h.name_size = fld[7]
@@ -849,19 +1225,11 @@ class RarFile(object):
         if h.flags & RAR_FILE_UNICODE:
             nul = name.find(ZERO)
             h.orig_filename = name[:nul]
-            u = UnicodeFilename(h.orig_filename, name[nul + 1 : ])
-            h.filename = u.decode()
-
-            # if parsing failed fall back to simple name
-            if u.failed:
-                h.filename = self._decode(h.orig_filename)
+            h._uname = name[nul + 1 : ]
         else:
             h.orig_filename = name
-            h.filename = self._decode(name)
-
-        # change separator, if requested
-        if PATH_SEP != '\\':
-            h.filename = h.filename.replace('\\', PATH_SEP)
+            h._uname = None
+        h._charset = self._charset
 
         if h.flags & RAR_FILE_SALT:
             h.salt = h.header_data[pos : pos + 8]
@@ -871,9 +1239,11 @@ class RarFile(object):
 
         # optional extended time stamps
         if h.flags & RAR_FILE_EXTTIME:
-            pos = self._parse_ext_time(h, pos)
+            end = _ext_time_end(h.header_data, pos)
+            h._exttime = h.header_data[pos : end]
+            pos = end
         else:
-            h.mtime = h.atime = h.ctime = h.arctime = None
+            h._exttime = None
 
         # base header end
         h.header_base = pos
@@ -881,22 +1251,6 @@ class RarFile(object):
         if h.flags & RAR_FILE_COMMENT:
             self._parse_subblocks(h, pos)
 
-        # convert timestamps
-        if USE_DATETIME:
-            h.date_time = to_datetime(h.date_time)
-            h.mtime = to_datetime(h.mtime)
-            h.atime = to_datetime(h.atime)
-            h.ctime = to_datetime(h.ctime)
-            h.arctime = to_datetime(h.arctime)
-
-        # .mtime is .date_time with more precision
-        if h.mtime:
-            if USE_DATETIME:
-                h.date_time = h.mtime
-            else:
-                # keep seconds int
-                h.date_time = h.mtime[:5] + (int(h.mtime[5]),)
-
         return pos
 
     # find old-style comment subblock
@@ -927,40 +1281,6 @@ class RarFile(object):
 
             pos = pos_next
 
-    def _parse_ext_time(self, h, pos):
-        data = h.header_data
-
-        # flags and rest of data can be missing
-        flags = 0
-        if pos + 2 <= len(data):
-            flags = S_SHORT.unpack_from(data, pos)[0]
-            pos += 2
-
-        h.mtime, pos = self._parse_xtime(flags >> 3*4, data, pos, h.date_time)
-        h.ctime, pos = self._parse_xtime(flags >> 2*4, data, pos)
-        h.atime, pos = self._parse_xtime(flags >> 1*4, data, pos)
-        h.arctime, pos = self._parse_xtime(flags >> 0*4, data, pos)
-        return pos
-
-    def _parse_xtime(self, flag, data, pos, dostime = None):
-        unit = 10000000.0 # 100 ns units
-        if flag & 8:
-            if not dostime:
-                t = S_LONG.unpack_from(data, pos)[0]
-                dostime = parse_dos_time(t)
-                pos += 4
-            rem = 0
-            cnt = flag & 3
-            for i in range(cnt):
-                b = S_BYTE.unpack_from(data, pos)[0]
-                rem = (b << 16) | (rem >> 8)
-                pos += 1
-            sec = dostime[5] + rem / unit
-            if flag & 4:
-                sec += 1
-            dostime = dostime[:5] + (sec,)
-        return dostime, pos
-
     # given current vol name, construct next one
     def _next_volname(self, volfile):
         if self._main.flags & RAR_MAIN_NEWNUMBERING:
@@ -997,9 +1317,33 @@ class RarFile(object):
     def _open_clear(self, inf):
         return DirectReader(self, inf)
 
+    # extract with unrar tool
+    def _open_tool(self, inf, psw = None):
+        if self._use_hack(inf):
+            return self._open_hack(inf, psw)
+        else:
+            return self._open_unrar(self.rarfile, inf, psw)
+
+    # is temp write usable?
+    def _use_hack(self, inf):
+        if not USE_EXTRACT_HACK or not self._main:
+            return 0
+        elif self._main.flags & (RAR_MAIN_SOLID | RAR_MAIN_PASSWORD):
+            return 0
+        elif inf.flags & (RAR_FILE_SPLIT_BEFORE | RAR_FILE_SPLIT_AFTER):
+            return 0
+        elif inf.file_size > HACK_SIZE_LIMIT:
+            return 0
+        return 1
+
     # put file compressed data into temporary .rar archive, and run
     # unrar on that, thus avoiding unrar going over whole archive
     def _open_hack(self, inf, psw = None):
+        tmpname = self._write_hack(inf)
+        return self._open_unrar(tmpname, inf, psw, tmpname)
+
+    # write temporary .rar archive with single entry, return its name
+    def _write_hack(self, inf):
         BSIZE = 32*1024
 
         size = inf.compress_size + inf.header_size
@@ -1030,7 +1374,7 @@ class RarFile(object):
             os.unlink(tmpname)
             raise
 
-        return self._open_unrar(tmpname, inf, psw, tmpname)
+        return tmpname
 
     def _read_comment_v3(self, inf, psw=None):
 
@@ -1072,12 +1416,7 @@ class RarFile(object):
         return PipeReader(self, inf, cmd, tmpfile)
 
     def _decode(self, val):
-        for c in TRY_ENCODINGS:
-            try:
-                return val.decode(c)
-            except UnicodeError:
-                pass
-        return val.decode(self._charset, 'replace')
+        return _decode_name(val, self._charset)
 
     def _decode_comment(self, val):
         if UNICODE_COMMENTS:
@@ -1344,6 +1683,28 @@ class RarExtFile(RawIOBase):
         # avoid RawIOBase default impl
         return self.read()
 
+    def iter_chunks(self, size = 64*1024):
+        """Iterate over remaining data in chunks of at most size bytes.
+
+        Chunks are filled with readinto(), so crc is checked as they
+        pass.  With memoryview support each chunk is a view of one
+        buffer that is reused for the next chunk, copy it to keep it.
+        """
+        if not have_memoryview:
+            while 1:
+                data = self.read(size)
+                if not data:
+                    break
+                yield data
+            return
+        buf = bytearray(size)
+        vbuf = memoryview(buf)
+        while 1:
+            n = self.readinto(buf)
+            if not n:
+                break
+            yield vbuf[:n]
+
 
 class PipeReader(RarExtFile):
     """Read data from pipe, handle tempfile cleanup."""
@@ -1409,6 +1770,59 @@ class PipeReader(RarExtFile):
                 if self.crc_check:
                     self.CRC = crc32(vbuf[:res], self.CRC)
                 self.remain -= res
+            if self.remain == 0 or (not res and len(buf) > 0):
+                self._check()
+            return res
+
+
+class StreamReader(RarExtFile):
+    """Read an entry from the output of unrar shared by all entries,
+    see RarFile.iterstream().
+    """
+
+    def __init__(self, rf, inf, stream):
+        self.stream = stream
+        self.opened = 0
+        RarExtFile.__init__(self, rf, inf)
+
+    def _open(self):
+        if self.opened:
+            raise BadRarFile("Cannot seek back in archive stream: " + self.inf.filename)
+        RarExtFile._open(self)
+        self.opened = 1
+
+    def _read(self, cnt):
+        """Read from shared pipe."""
+        return self.stream.read(cnt)
+
+    def close(self):
+        """Skip unread data, so next entry starts in place."""
+
+        if self.stream:
+            self.crc_check = 0
+            _skip_stream(self.stream, self.remain)
+            self.remain = 0
+            self.stream = None
+        RarExtFile.close(self)
+
+    def seekable(self):
+        """Returns False"""
+        return False
+
+    if have_memoryview:
+        def readinto(self, buf):
+            """Zero-copy read directly into buffer."""
+            cnt = len(buf)
+            if cnt > self.remain:
+                cnt = self.remain
+            vbuf = memoryview(buf)
+            res = self.stream.readinto(vbuf[0:cnt])
+            if res:
+                if self.crc_check:
+                    self.CRC = crc32(vbuf[:res], self.CRC)
+                self.remain -= res
+            if self.remain == 0 or (not res and len(buf) > 0):
+                self._check()
             return res
 
 
@@ -1448,7 +1862,7 @@ class DirectReader(RarExtFile):
     def _read(self, cnt):
         """Read from potentially multi-volume archive."""
 
-        buf = EMPTY
+        parts = []
         while cnt > 0:
             # next vol needed?
             if self.cur_avail == 0:
@@ -1466,12 +1880,11 @@ class DirectReader(RarExtFile):
             # got some data
             cnt -= len(data)
             self.cur_avail -= len(data)
-            if buf:
-                buf += data
-            else:
-                buf = data
+            parts.append(data)
 
-        return buf
+        if len(parts) == 1:
+            return parts[0]
+        return EMPTY.join(parts)
 
     def _open_next(self):
         """Proceed to next volume."""
@@ -1529,15 +1942,438 @@ class DirectReader(RarExtFile):
                 self.cur_avail -= res
                 self.remain -= res
                 got += res
+            if self.remain == 0 or (not got and len(buf) > 0):
+                self._check()
             return got
 
 
+class LibReader(RarExtFile):
+    """Extract entry with unrar library, see UnrarLibDecompressor."""
+
+    def __init__(self, rf, inf, lib, psw):
+        self.lib = lib
+        self.psw = psw
+        self.tempfile = None
+        RarExtFile.__init__(self, rf, inf)
+
+    def _open(self):
+        RarExtFile._open(self)
+
+        # same temp archive trick as with unrar
+        if self.rf._use_hack(self.inf):
+            if not self.tempfile:
+                self.tempfile = self.rf._write_hack(self.inf)
+            arcname, idx = self.tempfile, 0
+        else:
+            arcname = self.rf.rarfile
+            idx = self.rf._info_list.index(self.inf)
+        self.fd = UnrarLibStream(self.lib, arcname, [(idx, self.inf)], self.psw)
+
+    def _read(self, cnt):
+        """Read from extraction thread."""
+        return self.fd.read(cnt)
+
+    def close(self):
+        """Close open resources."""
+
+        RarExtFile.close(self)
+
+        if self.tempfile:
+            try:
+                os.unlink(self.tempfile)
+            except OSError:
+                pass
+            self.tempfile = None
+
+    if have_memoryview:
+        def readinto(self, buf):
+            """Zero-copy read directly into buffer."""
+            cnt = len(buf)
+            if cnt > self.remain:
+                cnt = self.remain
+            vbuf = memoryview(buf)
+            res = self.fd.readinto(vbuf[0:cnt])
+            if res:
+                if self.crc_check:
+                    self.CRC = crc32(vbuf[:res], self.CRC)
+                self.remain -= res
+            if self.remain == 0 or (not res and len(buf) > 0):
+                self._check()
+            return res
+
+
+class UnrarLibStream(object):
+    """Data of archive entries extracted by unrar library, in one
+    stream like unrar output.
+
+    The library runs in a thread that passes the data on in chunks,
+    a few chunks are buffered.  Provides .read(), .readinto() and
+    .close(), errors of the extraction are raised from the reads.
+
+    @param wanted: list of (position in RarFile.infolist(), RarInfo),
+                   in archive order.
+    """
+
+    def __init__(self, lib, arcname, wanted, psw):
+        self.queue = Queue(4)
+        self.stop = 0
+        self.eof = 0
+        self.buf = EMPTY
+        self.view = None
+        self.pos = 0
+        self.thread = threading.Thread(target = self._run,
+                                       args = (lib, arcname, wanted, psw))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self, lib, arcname, wanted, psw):
+        try:
+            lib.extract(arcname, wanted, psw, self._put)
+        except Exception:
+            self._put(sys.exc_info()[1])
+        self._put(None)
+
+    def _put(self, item):
+        """Called by extraction thread, returns False to abort."""
+        if self.stop:
+            return False
+        self.queue.put(item)
+        return True
+
+    def _next(self):
+        """Take next chunk, return False at end."""
+        if self.eof:
+            return False
+        item = self.queue.get()
+        if item is None:
+            self.eof = 1
+            return False
+        if isinstance(item, Exception):
+            self.eof = 1
+            raise item
+        self.buf = item
+        if have_memoryview:
+            self.view = memoryview(item)
+        self.pos = 0
+        return True
+
+    def read(self, cnt):
+        parts = []
+        while cnt > 0:
+            if self.pos >= len(self.buf) and not self._next():
+                break
+            data = self.buf[self.pos : self.pos + cnt]
+            self.pos += len(data)
+            cnt -= len(data)
+            parts.append(data)
+        if len(parts) == 1:
+            return parts[0]
+        return EMPTY.join(parts)
+
+    def readinto(self, buf):
+        got = 0
+        while got < len(buf):
+            if self.pos >= len(self.buf) and not self._next():
+                break
+            cnt = min(len(buf) - got, len(self.buf) - self.pos)
+            buf[got : got + cnt] = self.view[self.pos : self.pos + cnt]
+            self.pos += cnt
+            got += cnt
+        return got
+
+    def close(self):
+        """Stop extraction, wait for the thread."""
+        if not self.thread:
+            return
+        self.stop = 1
+        while 1:
+            # unblock pending put
+            try:
+                while 1:
+                    self.queue.get_nowait()
+            except Empty:
+                pass
+            self.thread.join(0.01)
+            if not self.thread.is_alive():
+                break
+        self.thread = None
+
+
+##
+## Decompressor backends
+##
+
+class Decompressor(object):
+    """In-process extraction backend, see DECOMPRESSORS.
+
+    RarFile.open() and RarFile.iterstream() use the first backend
+    that accepts all requested entries.  Entries that no backend
+    accepts are extracted with unrar tool.
+    """
+
+    def accepts(self, rf, inf, psw):
+        """Return True if entry can be extracted."""
+        return False
+
+    def open(self, rf, inf, psw):
+        """Return RarExtFile for entry.  Extracts it with unrar
+        tool by default, like RarFile.open() without backends.
+        """
+        return rf._open_tool(inf, psw)
+
+    def iterstream(self, rf, infos, psw):
+        """Yield (RarInfo, file object) for infos in archive order,
+        see RarFile.iterstream().  Opens each entry by default.
+        """
+        for inf in infos:
+            f = self.open(rf, inf, psw)
+            try:
+                yield inf, f
+            finally:
+                f.close()
+
+
+class StoreDecompressor(Decompressor):
+    """Uncompressed entries, read directly from archive."""
+
+    def accepts(self, rf, inf, psw):
+        return inf.compress_type == RAR_M0 and not inf.needs_password()
+
+    def open(self, rf, inf, psw):
+        return rf._open_clear(inf)
+
+
+class UnrarLibDecompressor(Decompressor):
+    """Any entry, extracted with unrar library, see UNRAR_LIB.
+
+    The library does the work of unrar tool without starting
+    a process per archive or entry.  The GIL is released while
+    it runs.
+    """
+
+    def __init__(self):
+        self._libs = {}
+
+    def _load(self):
+        """Return library binding, None if not available."""
+        path = UNRAR_LIB
+        if path is None and _have_ctypes:
+            path = ctypes.util.find_library('unrar')
+        if not path or not _have_ctypes:
+            return None
+        try:
+            return self._libs[path]
+        except KeyError:
+            pass
+        try:
+            lib = _UnrarLib(path)
+        except (OSError, AttributeError):
+            lib = None
+        self._libs[path] = lib
+        return lib
+
+    def accepts(self, rf, inf, psw):
+        if inf.needs_password() and psw is None:
+            return False
+        return self._load() is not None
+
+    def open(self, rf, inf, psw):
+        return LibReader(rf, inf, self._load(), psw)
+
+    def iterstream(self, rf, infos, psw):
+        order = {}
+        for i, inf in enumerate(rf._info_list):
+            order[id(inf)] = i
+        wanted = [(order[id(inf)], inf) for inf in infos]
+        stream = UnrarLibStream(self._load(), rf.rarfile, wanted, psw)
+        try:
+            for idx, inf in wanted:
+                f = StreamReader(rf, inf, stream)
+                try:
+                    yield inf, f
+                finally:
+                    f.close()
+        finally:
+            stream.close()
+
+
+# unrar library constants, see dll.hpp
+_ERAR_END_ARCHIVE = 10
+_ERAR_BAD_DATA = 12
+_ERAR_MISSING_PASSWORD = 22
+_RAR_OM_EXTRACT = 1
+_RAR_SKIP = 0
+_RAR_TEST = 1
+_RAR_VOL_NOTIFY = 1
+_UCM_CHANGEVOLUME = 0
+_UCM_PROCESSDATA = 1
+_UCM_CHANGEVOLUMEW = 3
+
+_UNRAR_ERRORS = {
+    11: 'Out of memory',
+    12: 'Corrupt data',
+    13: 'Broken archive',
+    14: 'Unknown archive format',
+    15: 'Cannot open archive',
+    18: 'Read error',
+    22: 'Password required',
+    24: 'Wrong password',
+}
+
+if _have_ctypes:
+    # structs are packed, trailing fields of newer library
+    # versions are covered by the reserved space
+    class _RAROpenArchiveDataEx(ctypes.Structure):
+        _pack_ = 1
+        _fields_ = [
+            ('ArcName', ctypes.c_char_p),
+            ('ArcNameW', ctypes.c_wchar_p),
+            ('OpenMode', ctypes.c_uint),
+            ('OpenResult', ctypes.c_uint),
+            ('CmtBuf', ctypes.c_char_p),
+            ('CmtBufSize', ctypes.c_uint),
+            ('CmtSize', ctypes.c_uint),
+            ('CmtState', ctypes.c_uint),
+            ('Flags', ctypes.c_uint),
+            ('Reserved', ctypes.c_uint * 64),
+        ]
+
+    class _RARHeaderDataEx(ctypes.Structure):
+        _pack_ = 1
+        _fields_ = [
+            ('ArcName', ctypes.c_char * 1024),
+            ('ArcNameW', ctypes.c_wchar * 1024),
+            ('FileName', ctypes.c_char * 1024),
+            ('FileNameW', ctypes.c_wchar * 1024),
+            ('Flags', ctypes.c_uint),
+            ('PackSize', ctypes.c_uint),
+            ('PackSizeHigh', ctypes.c_uint),
+            ('UnpSize', ctypes.c_uint),
+            ('UnpSizeHigh', ctypes.c_uint),
+            ('HostOS', ctypes.c_uint),
+            ('FileCRC', ctypes.c_uint),
+            ('Reserved', ctypes.c_uint * 2048),
+        ]
+
+class _UnrarLib(object):
+    """ctypes binding of unrar library."""
+
+    def __init__(self, path):
+        if sys.platform == 'win32':
+            dll = ctypes.WinDLL(path)
+            functype = ctypes.WINFUNCTYPE
+        else:
+            dll = ctypes.CDLL(path)
+            functype = ctypes.CFUNCTYPE
+        self.callback_type = functype(ctypes.c_int, ctypes.c_uint,
+                ctypes.c_ssize_t, ctypes.c_ssize_t, ctypes.c_ssize_t)
+        dll.RAROpenArchiveEx.argtypes = [ctypes.POINTER(_RAROpenArchiveDataEx)]
+        dll.RAROpenArchiveEx.restype = ctypes.c_void_p
+        dll.RARCloseArchive.argtypes = [ctypes.c_void_p]
+        dll.RARReadHeaderEx.argtypes = [ctypes.c_void_p, ctypes.POINTER(_RARHeaderDataEx)]
+        dll.RARProcessFile.argtypes = [ctypes.c_void_p, ctypes.c_int,
+                                       ctypes.c_char_p, ctypes.c_char_p]
+        dll.RARSetCallback.argtypes = [ctypes.c_void_p, self.callback_type, ctypes.c_ssize_t]
+        dll.RARSetPassword.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        self.dll = dll
+
+    def extract(self, arcname, wanted, psw, put):
+        """Pass data of wanted entries to put(), which returns
+        False to abort.
+
+        @param wanted: list of (position in RarFile.infolist(), RarInfo),
+                       in archive order.
+        """
+        dll = self.dll
+        od = _RAROpenArchiveDataEx()
+        od.ArcName = _fsencode(arcname)
+        od.OpenMode = _RAR_OM_EXTRACT
+        handle = dll.RAROpenArchiveEx(ctypes.byref(od))
+        if not handle:
+            raise self._error(od.OpenResult, arcname)
+
+        # [aborted, bytes of current entry]
+        state = [0, 0]
+        def callback(msg, user, p1, p2):
+            if msg == _UCM_PROCESSDATA:
+                state[1] += p2
+                if put(ctypes.string_at(p1, p2)):
+                    return 1
+                state[0] = 1
+                return -1
+            elif msg in (_UCM_CHANGEVOLUME, _UCM_CHANGEVOLUMEW):
+                # continue if next volume exists
+                if p2 == _RAR_VOL_NOTIFY:
+                    return 1
+            # password was given up front
+            return -1
+        cb = self.callback_type(callback)
+
+        try:
+            dll.RARSetCallback(handle, cb, 0)
+            if psw is not None:
+                dll.RARSetPassword(handle, _fsencode(psw))
+            hd = _RARHeaderDataEx()
+            pos = 0
+            for idx, inf in wanted:
+                # go to entry
+                while 1:
+                    res = dll.RARReadHeaderEx(handle, ctypes.byref(hd))
+                    if res == _ERAR_END_ARCHIVE:
+                        raise BadRarFile("Unexpected EOF: " + inf.filename)
+                    elif res:
+                        raise self._error(res, inf.filename)
+                    if pos == idx:
+                        break
+                    res = dll.RARProcessFile(handle, _RAR_SKIP, None, None)
+                    if res:
+                        raise self._error(res, inf.filename)
+                    pos += 1
+                size = hd.UnpSize | (hd.UnpSizeHigh << 32)
+                if size != inf.file_size:
+                    raise BadRarFile("Entry does not match header: " + inf.filename)
+
+                state[1] = 0
+                res = dll.RARProcessFile(handle, _RAR_TEST, None, None)
+                pos += 1
+                if state[0]:
+                    return
+                # bad crc is reported by RarExtFile
+                if res and not (res == _ERAR_BAD_DATA and state[1] == size):
+                    raise self._error(res, inf.filename)
+                if state[1] != size:
+                    raise BadRarFile("Failed the read enough data: " + inf.filename)
+        finally:
+            dll.RARCloseArchive(handle)
+
+    def _error(self, code, name):
+        if code == _ERAR_MISSING_PASSWORD:
+            return PasswordRequired("File %s requires password" % name)
+        msg = _UNRAR_ERRORS.get(code, 'Error %d' % code)
+        return BadRarFile("%s: %s" % (msg, name))
+
+def _fsencode(s):
+    """Name or password as bytes for unrar library."""
+    if isinstance(s, type(EMPTY)):
+        return s
+    return s.encode(sys.getfilesystemencoding() or 'utf8')
+
+# in-process extraction backends, in order of preference
+DECOMPRESSORS = [StoreDecompressor(), UnrarLibDecompressor()]
+
+
 class HeaderDecrypt:
-    """File-like object that decrypts from another file"""
+    """File-like object that decrypts from another file.
+
+    A read decrypts all blocks it needs with one read and one
+    cipher call.  Nothing is read past the last block needed,
+    so the file stays at the end of the header.
+    """
     def __init__(self, f, key, iv):
         self.f = f
         self.ciph = AES.new(key, AES.MODE_CBC, iv)
         self.buf = EMPTY
+        self.pos = 0
 
     def tell(self):
         return self.f.tell()
@@ -1547,30 +2383,23 @@ class HeaderDecrypt:
             raise BadRarFile('Bad count to header decrypt - wrong password?')
 
         # consume old data
-        if cnt <= len(self.buf):
-            res = self.buf[:cnt]
-            self.buf = self.buf[cnt:]
+        avail = len(self.buf) - self.pos
+        if cnt <= avail:
+            res = self.buf[self.pos : self.pos + cnt]
+            self.pos += cnt
             return res
-        res = self.buf
-        self.buf = EMPTY
-        cnt -= len(res)
+        res = self.buf[self.pos:]
+        cnt -= avail
 
-        # decrypt new data
+        # decrypt new data, whole blocks only
         BLK = self.ciph.block_size
-        while cnt > 0:
-            enc = self.f.read(BLK)
-            if len(enc) < BLK:
-                break
-            dec = self.ciph.decrypt(enc)
-            if cnt >= len(dec):
-                res += dec
-                cnt -= len(dec)
-            else:
-                res += dec[:cnt]
-                self.buf = dec[cnt:]
-                cnt = 0
-
-        return res
+        enc = self.f.read((cnt + BLK - 1) // BLK * BLK)
+        enc = enc[: len(enc) - len(enc) % BLK]
+        self.buf = self.ciph.decrypt(enc)
+        self.pos = min(cnt, len(self.buf))
+        if res:
+            return res + self.buf[:cnt]
+        return self.buf[:cnt]
 
 ##
 ## Utility functions
@@ -1579,6 +2408,9 @@ class HeaderDecrypt:
 def rar3_s2k(psw, salt):
     """String-to-key hash for RAR3."""
 
+    if have_memoryview:
+        return _rar3_s2k_fast(psw, salt)
+
     seed = psw.encode('utf-16le') + salt
     iv = EMPTY
     h = sha1()
@@ -1592,6 +2424,70 @@ def rar3_s2k(psw, salt):
     key_le = pack("<LLLL", *unpack(">LLLL", key_be))
     return key_le, iv
 
+def _rar3_s2k_fast(psw, salt):
+    """rar3_s2k() hashing a round of 0x4000 counters per call.
+
+    The records (seed + 3-byte counter) of a round are laid out in
+    a buffer column by column, between rounds only the counter
+    bytes change.  Same result as hashing record by record.
+    """
+    seed = psw.encode('utf-16le') + salt
+    cnt = 0x4000
+    width = len(seed) + 3
+    buf = bytearray(width * cnt)
+    for i, c in enumerate(bytearray(seed)):
+        buf[i :: width] = S_BYTE.pack(c) * cnt
+
+    # counter bytes: low byte cycles, middle byte steps every 256
+    # records, high byte is fixed in a round
+    low = EMPTY.join([S_BYTE.pack(c) for c in range(256)])
+    runs = [S_BYTE.pack(c) * 256 for c in range(256)]
+    buf[len(seed) :: width] = low * (cnt // 256)
+
+    view = memoryview(buf)
+    iv = []
+    h = sha1()
+    for i in range(16):
+        mid = (i * 0x40) & 0xFF
+        buf[len(seed) + 1 :: width] = EMPTY.join(runs[mid : mid + 0x40])
+        buf[len(seed) + 2 :: width] = S_BYTE.pack(i >> 2) * cnt
+        h.update(view[:width])
+        iv.append(h.digest()[19:20])
+        h.update(view[width:])
+    key_be = h.digest()[:16]
+    key_le = pack("<LLLL", *unpack(">LLLL", key_be))
+    return key_le, EMPTY.join(iv)
+
+_s2k_cache = {}     # (psw, salt) -> [key, iv, last use]
+_s2k_lock = threading.Lock()
+_s2k_clock = [0]
+
+def _cached_s2k(psw, salt):
+    """rar3_s2k() with results kept in an LRU of S2K_CACHE_SIZE."""
+    ck = (psw, salt)
+    _s2k_lock.acquire()
+    try:
+        _s2k_clock[0] += 1
+        ent = _s2k_cache.get(ck)
+        if ent:
+            ent[2] = _s2k_clock[0]
+            return ent[0], ent[1]
+    finally:
+        _s2k_lock.release()
+
+    key, iv = rar3_s2k(psw, salt)
+
+    _s2k_lock.acquire()
+    try:
+        while _s2k_cache and len(_s2k_cache) >= S2K_CACHE_SIZE:
+            old = min(_s2k_cache, key = lambda k: _s2k_cache[k][2])
+            del _s2k_cache[old]
+        if S2K_CACHE_SIZE > 0:
+            _s2k_cache[ck] = [key, iv, _s2k_clock[0]]
+    finally:
+        _s2k_lock.release()
+    return key, iv
+
 def rar_decompress(vers, meth, data, declen=0, flags=0, crc=0, psw=None, salt=None):
     """Decompress blob of compressed data.
 
@@ -1691,6 +2587,184 @@ def parse_dos_time(stamp):
     yr = (stamp & 0x7F) + 1980
     return (yr, mon, day, hr, min, sec * 2)
 
+def _ext_time_end(data, pos):
+    """Return end of extended time data starting at pos."""
+    # flags and rest of data can be missing
+    if pos + 2 > len(data):
+        return pos
+    flags = S_SHORT.unpack_from(data, pos)[0]
+    pos += 2
+    for i in range(4):
+        flag = flags >> (3 - i)*4
+        if flag & 8:
+            # mtime uses the dos time of the header
+            if i > 0:
+                pos += 4
+            pos += flag & 3
+    if pos > len(data):
+        raise struct.error('extended time data too short')
+    return pos
+
+def _parse_xtime(flag, data, pos, dostime = None):
+    unit = 10000000.0 # 100 ns units
+    if flag & 8:
+        if not dostime:
+            t = S_LONG.unpack_from(data, pos)[0]
+            dostime = parse_dos_time(t)
+            pos += 4
+        rem = 0
+        cnt = flag & 3
+        for i in range(cnt):
+            b = S_BYTE.unpack_from(data, pos)[0]
+            rem = (b << 16) | (rem >> 8)
+            pos += 1
+        sec = dostime[5] + rem / unit
+        if flag & 4:
+            sec += 1
+        dostime = dostime[:5] + (sec,)
+    return dostime, pos
+
+def _decode_times(dostime, exttime):
+    """Return (date_time, mtime, ctime, atime, arctime) of entry."""
+    date_time = parse_dos_time(dostime)
+    mtime = ctime = atime = arctime = None
+    if exttime:
+        flags = S_SHORT.unpack_from(exttime)[0]
+        pos = 2
+        mtime, pos = _parse_xtime(flags >> 3*4, exttime, pos, date_time)
+        ctime, pos = _parse_xtime(flags >> 2*4, exttime, pos)
+        atime, pos = _parse_xtime(flags >> 1*4, exttime, pos)
+        arctime, pos = _parse_xtime(flags >> 0*4, exttime, pos)
+
+    # convert timestamps
+    if USE_DATETIME:
+        date_time = to_datetime(date_time)
+        mtime = to_datetime(mtime)
+        atime = to_datetime(atime)
+        ctime = to_datetime(ctime)
+        arctime = to_datetime(arctime)
+
+    # .mtime is .date_time with more precision
+    if mtime:
+        if USE_DATETIME:
+            date_time = mtime
+        else:
+            # keep seconds int
+            date_time = mtime[:5] + (int(mtime[5]),)
+
+    return (date_time, mtime, ctime, atime, arctime)
+
+def _decode_name(val, charset):
+    """Decode name bytes, falling back to charset."""
+    for c in TRY_ENCODINGS:
+        try:
+            return val.decode(c)
+        except UnicodeError:
+            pass
+    return val.decode(charset, 'replace')
+
+def _decode_filename(h):
+    """Return unicode filename of entry."""
+    name = None
+    if h._uname is not None:
+        u = UnicodeFilename(h.orig_filename, h._uname)
+        name = u.decode()
+        # if parsing failed fall back to simple name
+        if u.failed:
+            name = None
+    if name is None:
+        name = _decode_name(h.orig_filename, h._charset)
+
+    # change separator, if requested
+    if PATH_SEP != '\\':
+        name = name.replace('\\', PATH_SEP)
+    return name
+
+# header data is needed only while parsing, decoded fields and
+# charset are set again on load, they are not kept in index
+_INDEX_SKIP = ('header_data', '_charset', '_filename', '_times')
+
+def _dump_infos(infos):
+    """Turn RarInfo list into marshal-able columns.
+
+    Entries having the same fields set are grouped, each group
+    stores a list of values per field.
+    """
+    shapes = {}
+    for pos, h in enumerate(infos):
+        names = tuple([n for n in RarInfo.__slots__
+                       if n not in _INDEX_SKIP and hasattr(h, n)])
+        shapes.setdefault(names, []).append(pos)
+    groups = []
+    for names, positions in shapes.items():
+        cols = [[getattr(infos[pos], n) for pos in positions] for n in names]
+        groups.append((names, positions, cols))
+    return (len(infos), groups)
+
+def _restore_infos(data):
+    """Rebuild RarInfo list from _dump_infos() result."""
+    count, groups = data
+    infos = [RarInfo() for i in range(count)]
+    for names, positions, cols in groups:
+        objs = [infos[pos] for pos in positions]
+        for name, col in zip(names, cols):
+            # slot descriptor called from map() avoids a python loop
+            list(map(RarInfo.__dict__[name].__set__, objs, col))
+    return infos
+
+def _subview(buf, start, end):
+    """Slice of buf, without a copy on 2.x.  Needs start <= end."""
+    if _have_buffer:
+        return buffer(buf, start, end - start)
+    return buf[start:end]
+
+class _NeedFileParse(Exception):
+    """Archive cannot be parsed from a map."""
+
+class _MappedFile(object):
+    """Read-only file object over a memory-mapped volume.
+
+    read() returns buffers into the map instead of copies,
+    these are invalid after close().  Header parsing works
+    on mm directly.
+    """
+    def __init__(self, fn):
+        f = open(fn, "rb")
+        try:
+            self.mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+        self.size = len(self.mm)
+        self.pos = 0
+
+    def read(self, cnt = None):
+        pos = self.pos
+        if cnt is None or cnt < 0 or pos + cnt > self.size:
+            cnt = max(0, self.size - pos)
+        self.pos = pos + cnt
+        return buffer(self.mm, pos, cnt)
+
+    def seek(self, ofs, whence = 0):
+        if whence == 1:
+            ofs += self.pos
+        elif whence == 2:
+            ofs += self.size
+        self.pos = ofs
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.mm.close()
+
+def _skip_stream(fd, cnt):
+    """Read and discard cnt bytes from fd."""
+    while cnt > 0:
+        buf = fd.read(min(cnt, 64*1024))
+        if not buf:
+            break
+        cnt -= len(buf)
+
 def custom_popen(cmd):
     """Disconnect cmd from parent fds, read only from stdout."""
 
@@ -1704,3 +2778,80 @@ def custom_popen(cmd):
               creationflags = creationflags)
     return p
 
+
+
+if __name__ == '__main__':
+    # Benchmark of cold and warm opens:
+    #   python rarfile.py ARCHIVE [ROUNDS [PASSWORD]]
+    # Cold opens parse all headers, read from the file or from a map,
+    # warm opens read the header index.  Then memory held by the listing,
+    # as opened and after decoding names and times.  With encrypted
+    # headers, give the password, the index is not used then.
+    import time, shutil
+    from tempfile import mkdtemp
+
+    def open_rar(fn):
+        rf = RarFile(fn)
+        if psw is not None:
+            rf.setpassword(psw)
+        return rf
+
+    def timed_open(fn, rounds):
+        best = None
+        for i in range(rounds):
+            t = time.time()
+            n = len(open_rar(fn).infolist())
+            t = time.time() - t
+            if best is None or t < best:
+                best = t
+        return best, n
+
+    def info_bytes(infos):
+        seen = set()
+        def size(obj):
+            # shared objects are counted once
+            if obj is None or id(obj) in seen:
+                return 0
+            seen.add(id(obj))
+            n = sys.getsizeof(obj)
+            if isinstance(obj, tuple):
+                n += sum([size(x) for x in obj])
+            elif isinstance(obj, RarInfo):
+                n += sum([size(getattr(obj, name, None)) for name in RarInfo.__slots__])
+            return n
+        return sum([size(h) for h in infos]) / max(1, len(infos))
+
+    fn = sys.argv[1]
+    rounds = 5
+    if len(sys.argv) > 2:
+        rounds = int(sys.argv[2])
+    psw = None
+    if len(sys.argv) > 3:
+        psw = sys.argv[3]
+    index_dir = INDEX_DIR = mkdtemp()
+    try:
+        index_dir = INDEX_DIR
+        INDEX_DIR = None
+        use_mmap = USE_MMAP
+        USE_MMAP = 0
+        cold, n = timed_open(fn, rounds)
+        USE_MMAP = use_mmap
+        mapped, n = timed_open(fn, rounds)
+        INDEX_DIR = index_dir
+        open_rar(fn)
+        warm, n = timed_open(fn, rounds)
+        print('%s: %d entries, cold open %.2f ms, mapped %.2f ms, warm open %.2f ms' % (
+              fn, n, cold * 1000, mapped * 1000, warm * 1000))
+
+        INDEX_DIR = None
+        rf = open_rar(fn)
+        listed = info_bytes(rf.infolist())
+        rf.getinfo(rf.namelist()[0])
+        named = info_bytes(rf.infolist()) + sys.getsizeof(rf._info_map) / max(1, n)
+        for h in rf.infolist():
+            h.date_time
+        timed = info_bytes(rf.infolist()) + sys.getsizeof(rf._info_map) / max(1, n)
+        print('listing: %d bytes/entry, names decoded %d, times decoded %d' % (
+              listed, named, timed))
+    finally:
+        shutil.rmtree(index_dir)
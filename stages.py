@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# This file is part of tweetproj
+#
+# A chain of stages connected by bounded queues. Every stage runs a number
+# of worker threads, a worker takes an item from its input queue and emits
+# any number of items into the input queue of the next stage. A full queue
+# blocks the emitting stage, so a slow stage throttles the stages before it
+# and memory use stays bounded by the queue sizes.
+
+import thread
+import threading
+import Queue
+
+from threading import Thread
+
+# End of input marker, one is queued per worker of the consuming stage
+_END = object()
+
+class Stage(object):
+  ''' A stage of a Pipeline, see Pipeline.add() '''
+  def __init__(self, name, func, workers, finish):
+    self.name = name
+    self.func = func
+    self.workers = max(1, workers)
+    self.finish = finish
+    self.inq = None
+    self.next = None
+    self._alive = 0
+    self._lock = thread.allocate_lock()
+
+
+class Pipeline(object):
+  ''' Runs items through a chain of stages.
+  @qsize    max number of items waiting in front of each stage
+  @stopped  callable polled before every item, once it returns True
+            the remaining items are dropped
+  @onerror  callable(stage_name, item, exception) for exceptions escaping
+            a stage function
+  '''
+  def __init__(self, qsize=4, stopped=None, onerror=None):
+    self._qsize = max(1, qsize)
+    self._stopped = stopped
+    self._onerror = onerror
+    self._stages = []
+
+  def add(self, name, func, workers=1, finish=None):
+    ''' Appends a stage.
+    @name     stage name
+    @func     func(item, emit) processes an item, emit(x) passes x on to
+              the next stage
+    @workers  number of threads running func
+    @finish   optional finish(emit), called in every worker thread once
+              the input of the stage is exhausted
+    '''
+    self._stages.append(Stage(name, func, workers, finish))
+    return self
+
+  def depths(self):
+    ''' Returns [(stage name, number of items queued)] '''
+    res = []
+    for s in self._stages:
+      n = 0
+      if s.inq is not None:
+        n = s.inq.qsize()
+      res.append((s.name, n))
+    return res
+
+  def run(self, items):
+    ''' Feeds items to the first stage and waits for all stages to finish '''
+    for (i, s) in enumerate(self._stages):
+      s.inq = Queue.Queue(self._qsize)
+      s._alive = s.workers
+      if i + 1 < len(self._stages):
+        s.next = self._stages[i + 1]
+
+    threads = []
+    for s in self._stages:
+      for n in range(s.workers):
+        th = Thread(target=self._work, args=(s,), name='%s-%d' % (s.name, n))
+        th.start()
+        threads.append(th)
+
+    first = self._stages[0]
+    try:
+      for item in items:
+        if self._is_stopped():
+          break
+        first.inq.put(item)
+    finally:
+      for n in range(first.workers):
+        first.inq.put(_END)
+      for th in threads:
+        th.join()
+
+  def _is_stopped(self):
+    return self._stopped is not None and self._stopped()
+
+  def _discard(self, item):
+    pass
+
+  def _work(self, s):
+    if s.next is not None:
+      emit = s.next.inq.put
+    else:
+      emit = self._discard
+    while True:
+      item = s.inq.get()
+      if item is _END:
+        break
+      # keep consuming after a stop so that producers never block
+      if self._is_stopped():
+        continue
+      try:
+        s.func(item, emit)
+      except Exception, e:
+        if self._onerror:
+          self._onerror(s.name, item, e)
+
+    if s.finish is not None:
+      try:
+        s.finish(emit)
+      except Exception, e:
+        if self._onerror:
+          self._onerror(s.name, None, e)
+
+    # the last worker of a stage ends the input of the next one
+    with s._lock:
+      s._alive -= 1
+      last = s._alive == 0
+    if last and s.next is not None:
+      for n in range(s.next.workers):
+        s.next.inq.put(_END)
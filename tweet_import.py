@@ -10,6 +10,10 @@ import thread
 import threading
 import json
 import time
+import getopt
+import bisect
+import multiprocessing
+import cStringIO
 
 # Thirdparty rarfile library
 import rarfile
@@ -20,50 +24,265 @@ import hbase
 # TaskTracker
 import gem
 
+# Staged pipeline
+import stages
+
+# Column layout of table tweets
+import schema
+
+# Incremental JSON array reader
+import jsonstream
+
+# Read-ahead of rar files
+import prefetch
+
+from hbase import pipeline
+from hbase import pool
+from hbase import region
+from hbase import codec
+
 from os.path import *
 
-from thrift.transport.TSocket import TSocket
-from thrift.transport.TTransport import TBufferedTransport
-from thrift.protocol import TBinaryProtocol
 from hbase import *
 from hbase.ttypes import *
 
 def usage():
-  print('Usage: tweet_import.py <ThriftServer[:Port]> <Source> [TrackerPort]')
-  print('  Default port of HBase Thrift server is 9090.')
+  print('Usage: tweet_import.py [Options] <ThriftServer[:Port][,ThriftServer[:Port]...]> <Source> [TrackerPort]')
+  print('  Default port of HBase Thrift server is 9090. Rows are spread over all the given servers.')
   print('  Source can be path to a .txt/.rar file or path to a directory containing .txt/.rar files.')
   print('  TrackerPort is optional. Default set to 10086')
+  print('Options:')
+  print('  -b, --batch-size=N   Rows per mutateRows call, default 100. 1 disables batching.')
+  print('  -B, --batch-bytes=N  Max bytes of row data per mutateRows call, default 2097152.')
+  print('  -p, --pipeline=N     Write requests kept in flight on each server, default 4.')
+  print('  -r, --region-aware   Group rows by region of table tweets before writing them.')
+  print('  -s, --stages=R,D,B,W Import with a staged pipeline using R reader, D JSON decoder,')
+  print('                       B mutation builder and W writer threads, e.g. 1,2,1,2.')
+  print('  -q, --queue-size=N   Items queued in front of each stage, default 4.')
+  print('  -P, --decode-procs=N Decode JSON and serialize rows in N worker processes instead of')
+  print('                       the decode and build threads. Implies --stages.')
+  print('  -x, --unrar-workers=N Extract up to N entries of a rar file at once, each with its')
+  print('                       own unrar run. Default 1, a single unrar run per rar file.')
+  print('  -f, --prefetch=N     Open the next N rar files of a directory ahead and extract their')
+  print('                       first entries while the current one is written, default 0.')
+  print('                       Not with --stages.')
+  print('  -m, --prefetch-mem=N Megabytes of data extracted ahead, default 256.')
+  print('  -i, --index-dir=DIR  Cache parsed rar headers in DIR, default log/rarindex. Empty')
+  print('                       to disable.')
+  print('  -u, --unrar-lib=PATH Extract with the unrar library at PATH in process instead of')
+  print('                       running unrar. By default it is looked up, empty to disable.')
+  print('  -l, --log-lines=N    Lines of log kept for the tracker page, default 80.')
+  print('  -L, --log-max=N      Rotate log/gem.PID.log past N megabytes, keeping 3 old files.')
+  print('                       Default 0, never.')
   print('Example:')
   print('  tweet_import.py master.hadoop.lab Part1')
+  print('  tweet_import.py slave1.hadoop.lab,slave2.hadoop.lab:9091 Part1')
   print('')
 
+def build_batches(tweets, fname, batch_size, batch_bytes, region_of=None, log=None,
+                  stopped=None, chkstep=2000):
+  ''' Serializes the rows of tweets and yields (processed, rows) for every
+  batch that is full, then the remaining partial batches. Rows are given
+  as codec.EncodedRow.
+  @region_of  optional callable mapping a row key to its region, rows of
+              different regions are never put in the same batch
+  @log        callable for warnings on malformed tweets
+  @stopped    optional callable, checked every chkstep tweets. Stops
+              building once it returns True
+  '''
+  processed = 0
+  encoder = codec.RowEncoder()
+  # pending rows by region: region -> [rows, bytes]
+  pending = {}
+  for t in tweets:
+    processed += 1
+    if stopped and processed % chkstep == 0 and stopped():
+      log('[INFO] Stop command detected, stop importing ...')
+      break
+    try:
+      row = encoder.encode(t['idstr'], schema.tweet_cells(t))
+    except Exception, e:
+      log('[WARNING] Tweet: %s(file: %s), Exception: %s' % (t.get('idstr'), fname, e))
+      continue
+    key = None
+    if region_of:
+      key = region_of(row.row)
+    slot = pending.setdefault(key, [[], 0])
+    slot[0].append(row)
+    slot[1] += len(row.data)
+    if len(slot[0]) >= batch_size or slot[1] >= batch_bytes:
+      del pending[key]
+      yield (processed, slot[0])
+  # rows built before a stop command are still written
+  for (rows, nbytes) in pending.values():
+    yield (processed, rows)
+
+def encode_file(args):
+  ''' Runs in a decoder process. Decodes a status file and builds its
+  batches of serialized rows.
+  @args  (fname, fdata, batch_size, batch_bytes, region start keys or None)
+  Returns (number of tweets, batches of codec.EncodedRow, warnings).
+  '''
+  (fname, fdata, batch_size, batch_bytes, starts) = args
+  tweets = json.loads(fdata)
+  region_of = None
+  if starts:
+    region_of = lambda row: bisect.bisect_right(starts, row) - 1
+  warnings = []
+  batches = []
+  for (processed, rows) in build_batches(tweets, fname, batch_size, batch_bytes,
+                                         region_of, warnings.append):
+    batches.append(rows)
+  return (len(tweets), batches, warnings)
+
+class FileJob(object):
+  ''' Import state of a data file, or of a file within a rar archive.
+  The producer of the batches of a file and every batch in flight hold a
+  reference to the job. Once the last reference is released the job is
+  finished and on_done(job) is called, then the parent job, if any, is
+  released.
+  '''
+  def __init__(self, name, on_done=None, parent=None):
+    self.name = name
+    self.parent = parent
+    self.failed = False
+    self._on_done = on_done
+    self._refs = 1
+    self._lock = thread.allocate_lock()
+    if parent is not None:
+      parent.acquire()
+
+  def acquire(self):
+    with self._lock:
+      self._refs += 1
+
+  def release(self, failed=False):
+    with self._lock:
+      if failed:
+        self.failed = True
+      self._refs -= 1
+      last = self._refs == 0
+    if last:
+      if self._on_done is not None:
+        self._on_done(self)
+      if self.parent is not None:
+        self.parent.release(self.failed)
+
+
 class TweetsImportWorker(object):
-  def __init__(self, tracker, server, port=9090, ignores=[]):
+  # path to status data within a rar file
+  STATUS_PREFIX = 'weibo_datas\\SinaNormalRobot\\Statuses\\'
+  STATUS_SUFFIX = '.txt'
+
+  def __init__(self, tracker, servers, ignores=[], batch_size=100, batch_bytes=2*1024*1024,
+               pipeline_depth=4, region_aware=False, stages=None, queue_size=4, decode_procs=0,
+               unrar_workers=1, prefetch_ahead=0, prefetch_mem=256*1024*1024):
+    ''' @servers       list of (host, port) of HBase Thrift gateways
+    @stages        None, or worker counts (read, decode, build, write) of the
+                   staged pipeline used by import_staged()
+    @queue_size    max items queued in front of each stage
+    @decode_procs  number of processes decoding JSON and serializing rows in
+                   import_staged(), 0 to do it in threads
+    @unrar_workers  number of rar entries extracted at once
+    @prefetch_ahead  number of rar files opened ahead by import_directory()
+    @prefetch_mem    max bytes of data extracted ahead
+    '''
     # Task tracker
     self._tracker = tracker
 
     # Files that should be ignored
     self._ignores = set(ignores)
 
+    # Entries of non-solid rar files are extracted by up to _unrar_workers
+    # unrar processes at once
+    self._unrar_workers = unrar_workers
+
+    # While a directory is imported, the next rar files are opened and
+    # their first entries extracted ahead by _prefetcher
+    self._prefetch_ahead = prefetch_ahead
+    self._prefetch_mem = prefetch_mem
+    self._prefetcher = None
+
     # Progress log
     self._progf = open('log/%d.done' % os.getpid(), 'a')
     
     # By default check stop flag every 2000 records
     self._chkstep = 2000
 
-    # HBase Thrift connection
-    self._transport = TBufferedTransport(TSocket(server, port))
-    self._transport.open()
-    protocol = TBinaryProtocol.TBinaryProtocol(self._transport)
-    self._client = Hbase.Client(protocol)
+    # Rows are sent with mutateRows in batches of at most _batch_size rows
+    # or _batch_bytes bytes of serialized rows, whichever comes first
+    self._batch_size = max(1, batch_size)
+    self._batch_bytes = batch_bytes
+
+    # HBase Thrift connections, broken ones are replaced transparently.
+    # Batches are spread over the gateways, up to pipeline_depth write
+    # requests are kept in flight on each of them
+    self._stages = stages or (1, 1, 1, 1)
+    self._queue_size = queue_size
+    self._pipeline_depth = pipeline_depth
+    self._pools = [pool.ConnectionPool(host, port, maxsize=self._stages[3] + 1)
+                   for (host, port) in servers]
+    self._latency = tracker.histogram('thrift_call_seconds',
+                                      'Latency of Thrift write calls, from send to reply.')
+    self._writer = pipeline.FanoutClient(self._pools, pipeline_depth, latency=self._latency.observe)
+    self._writers = [self._writer]
+
+    # Queues of the import, exported by the tracker
+    self._pipeline = None
+    tracker.add_gauge('queue_depth', 'Items queued in front of each stage of the staged import.',
+                      self._queue_depths, 'stage')
+    tracker.add_gauge('writes_in_flight', 'Write requests sent and not answered yet.',
+                      self._writes_in_flight)
+    tracker.add_gauge('prefetch_archives', 'Rar files opened ahead.',
+                      lambda: self._prefetch_held()[0])
+    tracker.add_gauge('prefetch_bytes', 'Bytes of rar entries extracted ahead.',
+                      lambda: self._prefetch_held()[1])
+
+    # JSON decoding and row building hold the GIL, with decode_procs they
+    # run in a process pool and the write stage gets serialized rows
+    self._decode_procs = decode_procs
+
+    # Files of the staged import done so far, for progress
+    self._sources_total = 0
+    self._sources_done = 0
+    self._sources_lock = thread.allocate_lock()
+    self._procs = None
+
+    # Writers of the write stage, one per thread
+    self._local = threading.local()
+
+    # Optionally rows are grouped by region so that every mutateRows call
+    # touches a single region server
+    self._router = None
+    if region_aware:
+      self._router = region.RegionRouter(self._pools[0].client(), 'tweets')
   
   def dispose(self):
-    self._transport.close()
+    self._writer.close()
+    for p in self._pools:
+      p.close()
     self._tracker.stop()
     self._progf.close()
 
   def log(self, msg):
     self._tracker.log(msg)
+
+  def _queue_depths(self):
+    if self._pipeline is None:
+      return []
+    return self._pipeline.depths()
+
+  def _writes_in_flight(self):
+    n = 0
+    for w in self._writers:
+      n += w.outstanding()
+    return n
+
+  def _prefetch_held(self):
+    prefetcher = self._prefetcher
+    if prefetcher is None:
+      return (0, 0)
+    return prefetcher.held()
   
   def prog(self, fname):
     ''' Log import progress. For each file, or file within a rar archive, we
@@ -74,120 +293,167 @@ class TweetsImportWorker(object):
     self._progf.flush()
     #os.fsync(self._progf.fileno())
 
-  def _af(self, mlist, t, name, cf=''):
-    ''' Adds a field to mutation list.
-    @mlist  target mutation list
-    @t      source tweet struct
-    @name   filed name
-    @cf     column family, should ends with a semicolon
-    '''
-    if not name in t:
-      mlist.append(Mutation(column=cf+name+':', value=json.dumps(None)))
-    else:
-      mlist.append(Mutation(column=cf+name+':', value=json.dumps(t[name]).encode('utf8')))
-      
-  def _create_mutations(self, t):
-    ''' Creates a mutation list based on the tweet struct. '''
-    mlist = []
-    # basic fields
-    self._af(mlist, t, 'idstr')
-    self._af(mlist, t, 'text')
-    self._af(mlist, t, 'created_at')
-    self._af(mlist, t, 'geo')
-    self._af(mlist, t, 'source')
-    self._af(mlist, t, 'truncated')
-    self._af(mlist, t, 'comments_count')
-    self._af(mlist, t, 'reposts_count')
-    
-    # user fields
-    user = t['user']
-    self._af(mlist, user, 'idstr', 'user:')
-    self._af(mlist, user, 'name', 'user:')
-    self._af(mlist, user, 'gender', 'user:')
-    self._af(mlist, user, 'location', 'user:')
-    self._af(mlist, user, 'province', 'user:')
-    self._af(mlist, user, 'city', 'user:')
-    self._af(mlist, user, 'created_at', 'user:')
-    self._af(mlist, user, 'description', 'user:')
-    self._af(mlist, user, 'url', 'user:')
-    self._af(mlist, user, 'bi_followers_count', 'user:')
-    self._af(mlist, user, 'friends_count', 'user:')
-    self._af(mlist, user, 'followers_count', 'user:')
-    self._af(mlist, user, 'statuses_count', 'user:')
-    
-    # retweet fields
-    if 'retweeted_status' in t:
-      rt = t['retweeted_status']
-      # basic fields of retweeted status
-      self._af(mlist, rt, 'idstr', 'rt:')
-      self._af(mlist, rt, 'text', 'rt:')
-      self._af(mlist, rt, 'created_at', 'rt:')
-      self._af(mlist, rt, 'geo', 'rt:')
-      self._af(mlist, rt, 'source', 'rt:')
-      self._af(mlist, rt, 'truncated', 'rt:')
-      self._af(mlist, rt, 'comments_count', 'rt:')
-      self._af(mlist, rt, 'reposts_count', 'rt:')
-      
-      # user fields of retweeted status
-      if 'user' in rt:
-        rt_user = rt['user']
-        self._af(mlist, rt_user, 'idstr', 'rt:user:')
-        self._af(mlist, rt_user, 'name', 'rt:user:')
-        self._af(mlist, rt_user, 'gender', 'rt:user:')
-        self._af(mlist, rt_user, 'location', 'rt:user:')
-        self._af(mlist, rt_user, 'province', 'rt:user:')
-        self._af(mlist, rt_user, 'city', 'rt:user:')
-        self._af(mlist, rt_user, 'created_at', 'rt:user:')
-        self._af(mlist, rt_user, 'description', 'rt:user:')
-        self._af(mlist, rt_user, 'url', 'rt:user:')
-        self._af(mlist, rt_user, 'bi_followers_count', 'rt:user:')
-        self._af(mlist, rt_user, 'friends_count', 'rt:user:')
-        self._af(mlist, rt_user, 'followers_count', 'rt:user:')
-        self._af(mlist, rt_user, 'statuses_count', 'rt:user:')
-    return mlist
-  
   def set_chk_step(self, step = 1000):
     self._chkstep = step
 
   def stop_flag_is_set(self):
     return self._tracker.fstop()
 
-  def _do_import(self, tweets, fname):
-    ''' Imports data from a single text file '''
-    self.log('[INFO] Processing %s, %d tweets' % (fname, len(tweets)))
-    self._tracker.update_task_status(current=fname)
-    self._tracker.update_progress(value=0, max=len(tweets))
+  def _flush_batch(self, writer, job, batch):
+    ''' Sends a batch of serialized rows with a single mutateRows call. The
+    reply is handled by _complete() once it arrives.
+    '''
+    if batch:
+      job.acquire()
+      self._submit(writer, (job, batch))
+
+  def _submit(self, writer, tag):
+    (job, batch) = tag
+    if isinstance(batch[0], codec.EncodedRow):
+      done = writer.submit_encoded(tag, 'mutateRows', codec.mutate_rows_args('tweets', batch))
+    else:
+      # a row retried on its own, see _complete()
+      done = writer.submit(tag, 'mutateRow', 'tweets', batch[0].row, batch[0].mutations, None)
+    self._complete(writer, done)
+
+  def _complete(self, writer, done):
+    ''' Handles replies of write requests. A failed batch is written again
+    row by row so that a bad row is isolated and logged on its own. Only
+    then rows are decoded into Mutation objects, for mutateRow. A row lost
+    for any other reason than its data, e.g. a broken connection, fails
+    its job, so that the file is not logged as done.
+    '''
+    retries = []
+    for ((job, batch), e) in done:
+      if e is None:
+        # update record counter
+        self._tracker.add_records(len(batch))
+        job.release()
+        continue
+      if self._router and self._router.check_error(e):
+        self.log('[INFO] Regions of table tweets moved, reloading region map. Exception: %s' % e)
+      if len(batch) > 1:
+        self.log('[INFO] Batch of %d rows failed(file: %s), retrying row by row. Exception: %s' % (len(batch), job.name, e))
+        for b in batch:
+          job.acquire()
+          retries.append((job, [codec.decode_row(b.data)]))
+      elif isinstance(e, pipeline.DATA_ERRORS):
+        self.log('[WARNING] Tweet: %s(file: %s), Exception: %s' % (batch[0].row, job.name, e))
+      else:
+        self.log('[ERROR] Tweet: %s(file: %s) not written, Exception: %s' % (batch[0].row, job.name, e))
+        job.release(True)
+        continue
+      job.release()
+    for tag in retries:
+      self._submit(writer, tag)
+
+  def _wait_writes(self, writer):
+    ''' Waits for all write requests, including rows resent by _complete() '''
+    while writer.outstanding() > 0:
+      self._complete(writer, writer.drain())
+
+  def _batches(self, tweets, fname):
+    ''' Builds the rows of tweets in batches, see build_batches() '''
+    region_of = None
+    if self._router:
+      region_of = self._router.region_of
+    return build_batches(tweets, fname, self._batch_size, self._batch_bytes,
+                         region_of, self.log, self.stop_flag_is_set, self._chkstep)
+
+  def _do_import(self, fp, fname, size):
+    ''' Imports data from a single text file. Tweets are decoded from file
+    object fp one at a time while they are written.
+    @size  size of the file in bytes, for progress
+    '''
+    self.log('[INFO] Processing %s, %d bytes' % (fname, size))
+    self._tracker.set_current(fname)
+    self._tracker.update_progress(value=0, max=size)
+    tweets = jsonstream.ArrayReader(fp)
+    job = FileJob(fname)
     finished = True
     try:
-      processed = 0
-      for t in tweets:
-        processed += 1
-        if processed % self._chkstep == 0 and self.stop_flag_is_set():
-          self.log('[INFO] Stop command detected, stop importing ...')
-          finished = False
-          break
-        try:
-          mutations = self._create_mutations(t)
-          self._client.mutateRow('tweets', t['idstr'], mutations, None)
-          # update record counter
-          self._tracker.update_task_status(records=1)
-        except Exception, e:
-          self.log('[WARNING] Tweet: %s(file: %s), Exception: %s' % (t['idstr'], fname, e))
-        self._tracker.update_progress(value=processed)
+      for (processed, rows) in self._batches(tweets, fname):
+        self._flush_batch(self._writer, job, rows)
+        self._tracker.update_progress(value=tweets.consumed)
+      self._wait_writes(self._writer)
+      if self.stop_flag_is_set() or job.failed:
+        finished = False
     except Exception, e:
       self.log('[FATAL] File: %s, Exception: %s' % (fname, e))
+      # rows sent before the error still count
+      self._wait_writes(self._writer)
       finished = False
 
     if finished:
       # update file counter
-      self._tracker.update_task_status(files=1)
+      self._tracker.add_files()
     return finished
 
+  def _status_infos(self, rf, fname, log=True):
+    ''' Returns the RarInfo of status files within rar archive rf that are
+    not ignored.
+    '''
+    entries = []
+    for f in rf.infolist():
+      if f.filename.endswith(self.STATUS_SUFFIX) and f.filename.startswith(self.STATUS_PREFIX):
+        fullname = fname + ':' + f.filename
+        if fullname not in self._ignores:
+          entries.append(f)
+        elif log:
+          self.log('[INFO] Ignored file: %s' % fullname)
+    return entries
+
+  def _status_entries(self, rf, fname, pre=None):
+    ''' Yields (fullname, RarInfo, file object) of status files within rar
+    archive rf that are not ignored. The archive is extracted by a single
+    unrar process, a file object is valid until the next entry is taken.
+    With more than one unrar worker, entries are extracted concurrently
+    and yielded as they complete. Entries extracted ahead, given by
+    prefetch.PrefetchedArchive pre, come first.
+    '''
+    entries = self._status_infos(rf, fname)
+    fetched = []
+    if pre is not None:
+      (fetched, pre.data) = (pre.data, [])
+      skip = set([id(f) for (f, data) in fetched])
+      entries = [f for f in entries if id(f) not in skip]
+    try:
+      while fetched:
+        (f, data) = fetched.pop(0)
+        try:
+          yield (fname + ':' + f.filename, f, cStringIO.StringIO(data))
+        finally:
+          self._prefetcher.release(f.file_size)
+
+      if self._unrar_workers > 1:
+        stream = rf.iterextract(entries, workers=self._unrar_workers)
+      else:
+        stream = rf.iterstream(entries)
+      try:
+        for (f, fp) in stream:
+          if isinstance(fp, str):
+            fp = cStringIO.StringIO(fp)
+          yield (fname + ':' + f.filename, f, fp)
+      finally:
+        stream.close()
+    finally:
+      for (f, data) in fetched:
+        self._prefetcher.release(f.file_size)
+
+  def _take_prefetched(self, fname):
+    ''' Returns the prefetch.PrefetchedArchive of rar file fname, or None '''
+    if self._prefetcher is None:
+      return None
+    pre = self._prefetcher.take(fname)
+    if pre is not None and pre.error is not None:
+      # the file is opened again, so that the error is reported as usual
+      for (f, data) in pre.data:
+        self._prefetcher.release(f.file_size)
+      pre = None
+    return pre
+
   def import_rar_file(self, fname):
     ''' Imports data from an rar file '''
-    # path to status data within a rar file
-    status_prefix = 'weibo_datas\\SinaNormalRobot\\Statuses\\'
-    status_suffix = '.txt'
     # Firstly we check whether the rar archive has been imported.
     # Later we'll check whether the file within the archive has been imported.
     self.log('[INFO] Processing file: %s' % fname)
@@ -196,24 +462,25 @@ class TweetsImportWorker(object):
       return False
     
     finished = True
+    pre = self._take_prefetched(fname)
     try:
-      rf = rarfile.RarFile(fname)
-      for f in rf.infolist():
-        if f.filename.endswith(status_suffix) and f.filename.startswith(status_prefix):
-          fullname = fname + ':' + f.filename
-          if fullname in self._ignores:
-            self.log('[INFO] Ignored file: %s' % fullname)
-          else:
-            fdata = rf.read(f)
-            tweets = json.loads(fdata)
-            if self._do_import(tweets, fullname):
-              self.prog(fullname)
-            self._tracker.update_task_status(bytes=len(fdata))
+      if pre is not None:
+        rf = pre.rf
+      else:
+        rf = rarfile.RarFile(fname)
+      entries = self._status_entries(rf, fname, pre)
+      for (fullname, f, fp) in entries:
+        if self._do_import(fp, fullname, f.file_size):
+          self.prog(fullname)
+        else:
+          finished = False
+        self._tracker.add_bytes(f.file_size)
         # Check for break
         if self.stop_flag_is_set():
           self.log('[INFO] Stop command detected, leaving file %s ...' % fname)
           finished = False
           break
+      entries.close()
       rf.close()
     except Exception, e:
       finished = False
@@ -233,11 +500,13 @@ class TweetsImportWorker(object):
     
     finished = True
     try:
-      with open(fname) as fp:
-        tweets = json.load(fp)
-      if self._do_import(tweets, fname):
-        self.prog(fname)
-      self._tracker.update_task_status(bytes=os.stat(fname).st_size)
+      size = os.stat(fname).st_size
+      with open(fname, 'rb') as fp:
+        if self._do_import(fp, fname, size):
+          self.prog(fname)
+        else:
+          finished = False
+      self._tracker.add_bytes(size)
     except Exception, e:
       finished = False
       self.log('[FATAL] File: %s, Exception: %s' % (fname, e))
@@ -254,35 +523,279 @@ class TweetsImportWorker(object):
   def import_directory(self, dname):
     self.log('[INFO] Processing directory: %s' % dname)
     try:
-      for file in os.listdir(dname):
+      files = [join(dname, file) for file in os.listdir(dname)]
+      if self._prefetch_ahead > 0:
+        rars = [f for f in files if f.endswith('.rar') and f not in self._ignores and isfile(f)]
+        self._prefetcher = prefetch.ArchivePrefetcher(rars, lambda rf, f: self._status_infos(rf, f, False),
+                                                      self._prefetch_ahead, self._prefetch_mem).start()
+      for fname in files:
         if self.stop_flag_is_set():
           self.log('[INFO] Stop command detected, leaving directory %s ...' % dname)
           break
-        fname = join(dname, file)
         if isfile(fname):
           self.import_file(fname)
     except Exception, e:
       self.log('[FATAL] Directory: %s, Exception: %s' % (dname, e))
       return False
+    finally:
+      if self._prefetcher is not None:
+        self._prefetcher.close()
+        self._prefetcher = None
+    return True
+
+  def import_staged(self, source):
+    ''' Imports a file or the files of a directory with a staged pipeline.
+    Reading files and rar entries, decoding JSON, building mutations and
+    writing them run in their own threads, connected by bounded queues, so
+    that CPU work and network I/O overlap.
+    '''
+    if isdir(source):
+      self.log('[INFO] Processing directory: %s' % source)
+      try:
+        files = [join(source, f) for f in os.listdir(source)]
+      except Exception, e:
+        self.log('[FATAL] Directory: %s, Exception: %s' % (source, e))
+        return False
+      files = [f for f in files if isfile(f)]
+    else:
+      files = [source]
+
+    with self._sources_lock:
+      self._sources_total = len(files)
+      self._sources_done = 0
+    self._tracker.update_progress(value=0, max=len(files))
+
+    (readers, decoders, builders, writers) = self._stages
+    p = stages.Pipeline(self._queue_size, self.stop_flag_is_set, self._stage_error)
+    self._pipeline = p
+    p.add('read', self._stage_read, readers)
+    if self._decode_procs > 0:
+      # fork before the stage threads are started. Every decode thread
+      # waits for one file in the pool, so keep at least one per process
+      self._procs = multiprocessing.Pool(self._decode_procs)
+      decoders = max(decoders, self._decode_procs)
+      p.add('decode', self._stage_encode, decoders)
+      self.log('[INFO] Decoding in %d processes' % self._decode_procs)
+    else:
+      p.add('decode', self._stage_decode, decoders)
+      p.add('build', self._stage_build, builders)
+    p.add('write', self._stage_write, writers, self._stage_write_finish)
+    self.log('[INFO] Staged import, workers read=%d decode=%d build=%d write=%d, queue size %d' % \
+             (readers, decoders, builders, writers, self._queue_size))
+    try:
+      p.run(files)
+    finally:
+      if self._procs is not None:
+        self._procs.terminate()
+        self._procs.join()
+        self._procs = None
+    if self.stop_flag_is_set():
+      self.log('[INFO] Stop command detected, staged import stopped.')
+      return False
     return True
 
+  def _stage_error(self, stage, item, e):
+    name = ''
+    if isinstance(item, tuple) and isinstance(item[0], FileJob):
+      name = item[0].name
+      item[0].release(True)
+    elif item is not None:
+      # a file the read stage failed on
+      name = item
+      self._source_done()
+    self.log('[FATAL] Stage: %s, File: %s, Exception: %s' % (stage, name, e))
+
+  def _file_done(self, job):
+    if not job.failed:
+      self.prog(job.name)
+      # update file counter
+      self._tracker.add_files()
+    if job.parent is None:
+      self._source_done()
+
+  def _archive_done(self, job):
+    # the whole rar file has been processed, then we log the rar file name
+    if not job.failed:
+      self.prog(job.name)
+    self._source_done()
+
+  def _source_done(self):
+    ''' Counts a file given to import_staged() as done, failed or not,
+    towards progress
+    '''
+    with self._sources_lock:
+      self._sources_done += 1
+      done = self._sources_done
+    self._tracker.update_progress(value=done, max=self._sources_total)
+
+  def _stage_read(self, fname, emit):
+    ''' Reads a .txt file, or the status files of a .rar file '''
+    self.log('[INFO] Processing file: %s' % fname)
+    if fname in self._ignores:
+      self.log('[INFO] Ignored file: %s' % fname)
+      self._source_done()
+      return
+    if fname.endswith('.txt'):
+      with open(fname, 'rb') as fp:
+        fdata = fp.read()
+      emit((FileJob(fname, self._file_done), fdata))
+    elif fname.endswith('.rar'):
+      arc = FileJob(fname, self._archive_done)
+      try:
+        rf = rarfile.RarFile(fname)
+        entries = self._status_entries(rf, fname)
+        for (fullname, f, fp) in entries:
+          emit((FileJob(fullname, self._file_done, arc), fp.read()))
+          if self.stop_flag_is_set():
+            self.log('[INFO] Stop command detected, leaving file %s ...' % fname)
+            arc.failed = True
+            break
+        entries.close()
+        rf.close()
+      except Exception, e:
+        self.log('[FATAL] File: %s, Exception: %s' % (fname, e))
+        arc.failed = True
+      arc.release()
+    else:
+      self.log('[INFO] Unrecognized file: %s' % fname)
+      self._source_done()
+
+  def _stage_decode(self, item, emit):
+    (job, fdata) = item
+    tweets = json.loads(fdata)
+    self._tracker.add_bytes(len(fdata))
+    self.log('[INFO] Processing %s, %d tweets' % (job.name, len(tweets)))
+    emit((job, tweets))
+
+  def _stage_encode(self, item, emit):
+    ''' Decodes a file and serializes its rows in the process pool, then
+    passes the batches of codec.EncodedRow on to the write stage.
+    '''
+    (job, fdata) = item
+    starts = None
+    if self._router:
+      starts = self._router.start_keys()
+    args = (job.name, fdata, self._batch_size, self._batch_bytes, starts)
+    (ntweets, batches, warnings) = self._procs.apply(encode_file, (args,))
+    self._tracker.add_bytes(len(fdata))
+    self._tracker.set_current(job.name)
+    self.log('[INFO] Processing %s, %d tweets' % (job.name, ntweets))
+    for msg in warnings:
+      self.log(msg)
+    for rows in batches:
+      job.acquire()
+      emit((job, rows))
+    job.release(self.stop_flag_is_set())
+
+  def _stage_build(self, item, emit):
+    (job, tweets) = item
+    self._tracker.set_current(job.name)
+    for (processed, rows) in self._batches(tweets, job.name):
+      job.acquire()
+      emit((job, rows))
+    job.release(self.stop_flag_is_set())
+
+  def _thread_writer(self):
+    writer = getattr(self._local, 'writer', None)
+    if writer is None:
+      writer = pipeline.FanoutClient(self._pools, self._pipeline_depth, latency=self._latency.observe)
+      self._local.writer = writer
+      self._writers.append(writer)
+    return writer
+
+  def _stage_write(self, item, emit):
+    (job, rows) = item
+    self._flush_batch(self._thread_writer(), job, rows)
+    # the build stage holds one reference per batch it emits
+    job.release()
+
+  def _stage_write_finish(self, emit):
+    writer = self._thread_writer()
+    self._wait_writes(writer)
+    writer.close()
+
 
 if __name__ == "__main__":
-  numarg = len(sys.argv)
-  if numarg != 3 and numarg != 4:
+  try:
+    (opts, args) = getopt.getopt(sys.argv[1:], 'b:B:p:rs:q:P:x:f:m:i:u:l:L:', ['batch-size=', 'batch-bytes=', 'pipeline=',
+                                                                     'region-aware', 'stages=', 'queue-size=',
+                                                                     'decode-procs=', 'unrar-workers=',
+                                                                     'prefetch=', 'prefetch-mem=', 'index-dir=',
+                                                                     'unrar-lib=', 'log-lines=', 'log-max='])
+  except getopt.GetoptError, e:
+    print(e)
     usage()
     exit(1)
+
+  numarg = len(args)
+  if numarg != 2 and numarg != 3:
+    usage()
+    exit(1)
+
+  batch_size = 100
+  batch_bytes = 2*1024*1024
+  pipeline_depth = 4
+  region_aware = False
+  staged = None
+  queue_size = 4
+  decode_procs = 0
+  unrar_workers = 1
+  prefetch_ahead = 0
+  prefetch_mem = 256
+  index_dir = 'log/rarindex'
+  unrar_lib = None
+  log_lines = 80
+  log_max = 0
+  for (opt, val) in opts:
+    if opt in ('-b', '--batch-size'):
+      batch_size = int(val)
+    elif opt in ('-B', '--batch-bytes'):
+      batch_bytes = int(val)
+    elif opt in ('-p', '--pipeline'):
+      pipeline_depth = int(val)
+    elif opt in ('-r', '--region-aware'):
+      region_aware = True
+    elif opt in ('-s', '--stages'):
+      staged = [int(n) for n in val.split(',')]
+      if len(staged) != 4:
+        usage()
+        exit(1)
+    elif opt in ('-q', '--queue-size'):
+      queue_size = int(val)
+    elif opt in ('-P', '--decode-procs'):
+      decode_procs = int(val)
+    elif opt in ('-x', '--unrar-workers'):
+      unrar_workers = int(val)
+    elif opt in ('-f', '--prefetch'):
+      prefetch_ahead = int(val)
+    elif opt in ('-m', '--prefetch-mem'):
+      prefetch_mem = int(val)
+    elif opt in ('-i', '--index-dir'):
+      index_dir = val
+    elif opt in ('-u', '--unrar-lib'):
+      unrar_lib = val
+    elif opt in ('-l', '--log-lines'):
+      log_lines = int(val)
+    elif opt in ('-L', '--log-max'):
+      log_max = int(val)
+  if decode_procs > 0 and not staged:
+    staged = [1, decode_procs, 1, 2]
+  if staged and prefetch_ahead > 0:
+    print('Warning: --prefetch does not apply to the staged import, ignored.')
+    prefetch_ahead = 0
   
-  thrift_server = sys.argv[1]
-  thrift_port = '9090'
-  if thrift_server.find(':') > 0:
-    (thrift_server, thrift_port) = sys.argv[1].split(':')
+  thrift_servers = []
+  for thrift_server in args[0].split(','):
+    thrift_port = '9090'
+    if thrift_server.find(':') > 0:
+      (thrift_server, thrift_port) = thrift_server.split(':')
+    thrift_servers.append((thrift_server, int(thrift_port)))
   
-  data_source = sys.argv[2]
+  data_source = args[1]
 
   tracker_port = '10086'
-  if numarg == 4:
-    tracker_port = sys.argv[3]
+  if numarg == 3:
+    tracker_port = args[2]
 
   ignores = []
   try:
@@ -292,11 +805,22 @@ if __name__ == "__main__":
   except:
     pass
 
-  tracker = gem.TaskTracker(port=int(tracker_port))
-  worker = TweetsImportWorker(tracker, thrift_server, int(thrift_port), ignores)
+  # Headers of rar files are parsed once, resumed runs read them from index
+  rarfile.INDEX_DIR = index_dir or None
+  rarfile.UNRAR_LIB = unrar_lib
+
+  tracker = gem.TaskTracker(port=int(tracker_port), loglines=log_lines,
+                            logmax=log_max*1024*1024)
+  worker = TweetsImportWorker(tracker, thrift_servers, ignores,
+                              batch_size=batch_size, batch_bytes=batch_bytes,
+                              pipeline_depth=pipeline_depth, region_aware=region_aware,
+                              stages=staged, queue_size=queue_size, decode_procs=decode_procs,
+                              unrar_workers=unrar_workers, prefetch_ahead=prefetch_ahead,
+                              prefetch_mem=prefetch_mem*1024*1024)
   
-  if isdir(data_source):
+  if staged:
+    tracker.run(worker.import_staged, [data_source])
+  elif isdir(data_source):
     tracker.run(worker.import_directory, [data_source])
   else:
     tracker.run(worker.import_file, [data_source])
-